@@ -0,0 +1,456 @@
+# coding=utf-8
+"""
+Benchmarks of the log processing pipelines on seeded synthetic data.
+
+Each benchmark generates its input once, and then runs the pipeline step in a fresh process,
+recording the wall and CPU time, the throughput and the peak memory to a JSON results file.
+If a baseline results file exists, the results are compared to it, and the script exits with 1 on regressions.
+
+    python benchmark.py [--size 100000] [--only weblogs,log2dfs] [--repeat 3] [--processes 0]
+                        [--results benchmark-results.json] [--baseline benchmark-baseline.json] [--save-baseline]
+"""
+import argparse
+import multiprocessing
+import platform
+import random
+import shutil
+import tempfile
+from datetime import timedelta
+
+from logprocessor import *
+
+
+# Synthetic data is generated around these values
+xcsList = ['250-99', '410-01', '420-01', '470-01', '502-13', '502-16', '404-01', '520-18', '612-03', '639-07']
+languages = ['en', 'ru', 'fr', 'ar', 'es', 'id', 'ms', 'th', 'sw', 'bn']
+smsPartners = [('mcc1', 'op1', 'Partner A'), ('mcc2', 'op2', ''), ('mcc3', 'op3', 'Partner C'),
+               ('mcc4', 'op4', u'Telco \xe9'.encode('utf8'))]
+smsPaths = [['start', 'titles', 'section', 'ussdcontent', 'smscontent', 'smscontent', 'more-no-content'],
+            ['start', 'titles', 'section-invalid'],
+            ['start', 'titles', 'section', 'smscontent', 'ussdcontent', 'smscontent', 'smscontent'],
+            ['start', 'titles', 'section', 'content-invalid'],
+            ['start', 'titles', 'titles', 'section'],
+            ['start']]
+
+
+def genVarnishLines(rnd, count, day):
+    """
+    Lines of a zero.tsv log, mostly valid, with about 1% of broken ones
+    """
+    hosts = ['en.m.wikipedia.org', 'ru.zero.wikipedia.org', 'fr.m.wikipedia.org.', 'www.wikipedia.org',
+             'ar.zero.wikipedia.org:80', 'meta.m.wikimedia.org', 'upload.wikimedia.org', 'bits.wikimedia.org']
+    statuses = ['hit/200'] * 6 + ['miss/200'] * 3 + ['pass/200', 'hit/304', 'miss/301', 'TCP_MISS/200', 'hit/404']
+    analytics = ['zero=%s', 'zero=%s;proxy=Opera', 'zero=%s;https=1', 'zeronet=b;zero=%s', 'zero=%s;proxy=Nokia']
+    userAgents = ['Mozilla/5.0%20(Linux;%20U;%20Android%202.3.5;%20en-us)%20Version/4.0%20Mobile%20Safari/534.30',
+                  'Opera/9.80%20(J2ME/MIDP;%20Opera%20Mini/4.2.14912/870;%20U;%20id)%20Presto/2.4.15',
+                  'Nokia200/2.0%20(11.81)%20Profile/MIDP-2.1%20Configuration/CLDC-1.1']
+    start = datetime(2014, 8, day)
+    for i in xrange(count):
+        ts = start + timedelta(seconds=86400 * i // count)
+        host = rnd.choice(hosts)
+        url = 'http://%s/wiki/Article_%d' % (host, rnd.randint(0, 5000))
+        if rnd.random() < 0.05:
+            url += '?action=render&zcmd=' + rnd.choice(['pre-esc', 'ret-esc', 'accept'])
+        fields = ['cp10%02d.eqiad.wmnet' % rnd.randint(0, 99), str(1386614108 + i), ts.strftime('%Y-%m-%dT%H:%M:%S'),
+                  '0.000%d' % rnd.randint(100, 999), '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255),
+                                                                    rnd.randint(0, 255)),
+                  rnd.choice(statuses), str(rnd.randint(200, 90000)), rnd.choice(['GET'] * 9 + ['POST']), url, '-',
+                  'text/html; charset=UTF-8', 'http://%s/' % host, '-', rnd.choice(userAgents),
+                  rnd.choice(languages), rnd.choice(analytics) % rnd.choice(xcsList)]
+        r = rnd.random()
+        if r < 0.004:
+            fields = fields[:10]
+        elif r < 0.007:
+            fields[-1] = '-'
+        elif r < 0.01:
+            fields[8] = 'garbage'
+        yield '\t'.join(fields) + '\n'
+
+
+def writeVarnishLog(filename, count, seed):
+    """
+    Write a gzipped varnish zero.tsv log
+    :return: number of lines written
+    """
+    rnd = random.Random(seed)
+    with gzip.open(filename, 'wb') as f:
+        f.writelines(genVarnishLines(rnd, count, 1))
+    return count
+
+
+def writeVumiLogs(dirPath, count, seed, days=3):
+    """
+    Write Vumi application logs, with some multi-line records, and a few very long ones
+    :return: number of records written
+    """
+    rnd = random.Random(seed)
+    perDay = count // days
+    for day in xrange(1, days + 1):
+        filename = os.path.join(dirPath, 'wikipedia_application_%d.log.2014-06-%02d' % (day % 2, day))
+        with io.open(filename, 'wb') as f:
+            for i in xrange(perDay):
+                ts = '2014-06-%02d %02d:%02d:%02d+0000' % (day, 24 * i // perDay, rnd.randint(0, 59),
+                                                           rnd.randint(0, 59))
+                if rnd.random() < 0.1:
+                    f.write(ts + ' [-] Starting factory <twisted.web.client._HTTP11ClientFactory instance>\n')
+                    continue
+                mcc, op, partner = rnd.choice(smsPartners)
+                f.write("%s %s WIKI\tu'%08d'\t%s\t%s\t%s\t%s\tcontent=u'%s'" % (
+                    ts, rnd.choice(['[VumiRedis,client]', '[HTTP11ClientProtocol,client]']),
+                    rnd.randint(0, max(10, count // 20)), mcc, op, partner,
+                    rnd.choice(['start', 'titles', 'section', 'smscontent', 'ussdcontent']),
+                    'word ' * rnd.randint(0, 20)))
+                for j in xrange(rnd.choice([0] * 20 + [1, 1, 5, 40, 400])):
+                    f.write('\nmore content line %d of the article' % j)
+                f.write('\n')
+    return perDay * days
+
+
+def writeSmsCombined(filename, count, seed):
+    """
+    Write the sorted combined SMS log, as created by SmsLogProcessor.combineDataFiles()
+    :return: number of lines written
+    """
+    rnd = random.Random(seed)
+    lines = set()
+    base = datetime(2014, 6, 1)
+    users = max(10, count // 30)
+    while len(lines) < count:
+        userId = '%08d' % rnd.randint(0, users)
+        mcc, op, partner = rnd.choice(smsPartners)
+        ts = base + timedelta(seconds=rnd.randint(0, 86400 * 60))
+        for action in rnd.choice(smsPaths):
+            ts += timedelta(seconds=rnd.randint(0, 40))
+            content = 'content=%d' % rnd.randint(0, 3000) if action.endswith('content') else 'query=foo bar'
+            lines.add('\t'.join([userId, ts.strftime('%Y-%m-%d %H:%M:%S'), mcc, op, partner, action, content]) + '\n')
+    with io.open(filename, 'wb') as f:
+        f.writelines(sorted(lines))
+    return len(lines)
+
+
+def writeZeroConfigs(filename, seed):
+    """
+    Write the zeroportal analyticsconfig API result, {xcs: [config, ...]}
+    """
+    rnd = random.Random(seed)
+    configs = {}
+    for xcs in xcsList:
+        items = []
+        frm = datetime(2014, 1, 1) + timedelta(days=rnd.randint(0, 300))
+        for i in xrange(rnd.randint(1, 3)):
+            before = frm + timedelta(days=rnd.randint(100, 700)) if rnd.random() < 0.5 else None
+            items.append({
+                'from': frm.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'before': before.strftime('%Y-%m-%dT%H:%M:%SZ') if before else None,
+                'languages': True if rnd.random() < 0.5 else rnd.sample(languages, 3),
+                'sites': True if rnd.random() < 0.3 else ['m.wikipedia', 'zero.wikipedia'],
+                'via': rnd.choice([['OPERA'], ['DIRECT'], ['DIRECT', 'OPERA']]),
+                'ipsets': rnd.choice([['default'], ['default', 'b']]),
+                'https': rnd.random() < 0.5,
+                'enabled': rnd.random() < 0.9,
+            })
+            if not before:
+                break
+            frm = before
+        configs[xcs] = items
+    saveJson(filename, configs)
+
+
+def writeHivePartitions(dirPath, count, seed, days=60):
+    """
+    Write the date=YYYY-MM-DD partitions of the zero_webstats Hive table, for the days before today
+    :return: number of rows written
+    """
+    rnd = random.Random(seed)
+    perDay = count // days
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in xrange(days):
+        datePath = os.path.join(dirPath, 'date=' + (today - timedelta(days=days - day)).strftime('%Y-%m-%d'))
+        os.makedirs(datePath)
+        files = [io.open(os.path.join(datePath, '%06d_0' % i), 'wb') for i in xrange(2)]
+        for i in xrange(perDay):
+            files[i % 2].write('\t'.join([
+                rnd.choice(xcsList + ['TEST-1', '999-99']), rnd.choice(['', 'DIRECT', 'OPERA', 'NOKIAPROD']),
+                rnd.choice(['', 'default', 'b']), rnd.choice(['', 'http', 'https']), rnd.choice(languages),
+                rnd.choice(['m', 'zero', '']), rnd.choice(['wikipedia'] * 8 + ['wikimedia', 'badsite']),
+                str(rnd.randint(1, 100000))]) + '\n')
+        for f in files:
+            f.close()
+    return perDay * days
+
+
+def writeSettings(runDir, inputDir, options):
+    """
+    Create the settings file of the benchmarked processor, with the logs read from the inputDir
+    """
+    settings = {
+        'pathLogs': inputDir,
+        'pathCache': os.path.join(runDir, 'cache'),
+        'pathGraphs': os.path.join(runDir, 'graphs'),
+        'parallelProcesses': options.processes,
+        'progressInterval': 3600,
+    }
+    filename = os.path.join(runDir, 'settings.json')
+    saveJson(filename, settings)
+    return filename
+
+
+class ConfigsWiki(object):
+    """
+    Replaces the zero wiki API in WebLogProcessor2.downloadConfigs() - returns the generated configs
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, action, **kwargs):
+        with io.open(self.filename, 'rb') as f:
+            return AttrDict(zeroportal=json.load(f, object_hook=AttrDict))
+
+
+def createWebLogProcessor2(runDir, inputDir, options):
+    import weblogs2
+
+    p = weblogs2.WebLogProcessor2(writeSettings(runDir, inputDir, options))
+    p.allowEdit = False
+    p.getWiki = lambda: ConfigsWiki(os.path.join(os.path.dirname(inputDir), 'configs.json'))
+    return p
+
+
+def prepareVarnish(inputDir, options):
+    return writeVarnishLog(os.path.join(inputDir, 'zero.tsv.log-20140801.gz'), options.size, options.seed)
+
+
+def runWeblogs(runDir, inputDir, options):
+    import weblogs
+
+    p = weblogs.WebLogProcessor(writeSettings(runDir, inputDir, options))
+    p.processLogFile(os.path.join(inputDir, 'zero.tsv.log-20140801.gz'),
+                     os.path.join(p.pathCache, 'zero.tsv.log-20140801.tsv'), '2014-08-01')
+
+
+def runLog2dfs(runDir, inputDir, options, parseBytes=False):
+    import log2dfs
+
+    p = log2dfs.LogConverter(settingsFile=writeSettings(runDir, inputDir, options))
+    p.settings.parseBytes = parseBytes
+    p.processLogFiles()
+
+
+def runLog2dfsBytes(runDir, inputDir, options):
+    runLog2dfs(runDir, inputDir, options, True)
+
+
+def prepareVumi(inputDir, options):
+    return writeVumiLogs(inputDir, options.size, options.seed)
+
+
+def runSmsCombine(runDir, inputDir, options):
+    import smslogs
+
+    p = smslogs.SmsLogProcessor(writeSettings(runDir, inputDir, options))
+    p.combineDataFiles()
+
+
+def prepareSmsCombined(inputDir, options):
+    return writeSmsCombined(os.path.join(inputDir, 'combined.tsv'), options.size, options.seed)
+
+
+def runSmsProcess(runDir, inputDir, options):
+    import smsgraphs
+
+    os.makedirs(os.path.join(runDir, 'graphs'))
+    stats = smsgraphs.Stats(os.path.join(inputDir, 'combined.tsv'), os.path.join(runDir, 'graphs'),
+                            os.path.join(runDir, 'combined.json'), salt='benchmark')
+    stats.process(options.processes)
+
+
+def prepareHive(inputDir, options):
+    writeZeroConfigs(os.path.join(os.path.dirname(inputDir), 'configs.json'), options.seed)
+    return writeHivePartitions(inputDir, options.size, options.seed)
+
+
+def runWeblogs2Combine(runDir, inputDir, options):
+    createWebLogProcessor2(runDir, inputDir, options).combineStats()
+
+
+def prepareWeblogs2Graphs(inputDir, options):
+    rows = prepareHive(inputDir, options)
+    # Create the combined file from the partitions, as combineStats() would, and keep it with the input
+    runDir = tempfile.mkdtemp(prefix='prepare-', dir=os.path.dirname(inputDir))
+    p = createWebLogProcessor2(runDir, inputDir, options)
+    p.combineStats()
+    shutil.move(p.combinedFile, os.path.join(os.path.dirname(inputDir), 'combined-all.tsv'))
+    shutil.rmtree(runDir)
+    return rows
+
+
+def runWeblogs2Graphs(runDir, inputDir, options):
+    p = createWebLogProcessor2(runDir, inputDir, options)
+    p.combinedFile = os.path.join(os.path.dirname(inputDir), 'combined-all.tsv')
+    p.generateGraphData()
+
+
+# name -> (input generator, benchmarked step, description)
+benchmarks = collections.OrderedDict([
+    ('weblogs', (prepareVarnish, runWeblogs, 'WebLogProcessor.processLogFile, varnish zero.tsv log')),
+    ('log2dfs', (prepareVarnish, runLog2dfs, 'LogConverter.processLogFile, varnish zero.tsv log')),
+    ('log2dfs-bytes', (prepareVarnish, runLog2dfsBytes, 'LogConverter.processLogFile with parseBytes')),
+    ('sms-combine', (prepareVumi, runSmsCombine, 'SmsLogProcessor.combineDataFiles, Vumi application logs')),
+    ('sms-process', (prepareSmsCombined, runSmsProcess, 'smsgraphs.Stats.process, combined SMS log')),
+    ('weblogs2-combine', (prepareHive, runWeblogs2Combine, 'WebLogProcessor2.combineStats, Hive partitions')),
+    ('weblogs2-graphs', (prepareWeblogs2Graphs, runWeblogs2Graphs, 'WebLogProcessor2.generateGraphData')),
+])
+
+
+def redirectOutput(logFile):
+    """
+    Send the progress output and warnings of the benchmarked code to the log file
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.stdout = sys.stderr = io.open(logFile, 'ab', buffering=0)
+
+
+def prepareWorker(name, benchDir, options):
+    """
+    Worker process - generate the input of the benchmark
+    """
+    redirectOutput(os.path.join(benchDir, 'output.log'))
+    inputDir = os.path.join(benchDir, 'input')
+    os.makedirs(inputDir)
+    return benchmarks[name][0](inputDir, options)
+
+
+def runWorker(name, benchDir, options):
+    """
+    Worker process - run the benchmark once, and measure it
+    """
+    redirectOutput(os.path.join(benchDir, 'output.log'))
+    runDir = os.path.join(benchDir, 'run')
+    if os.path.exists(runDir):
+        shutil.rmtree(runDir)
+    os.makedirs(runDir)
+
+    startCpu = getResourceUsage()[0]
+    startTs = time.time()
+    benchmarks[name][1](runDir, os.path.join(benchDir, 'input'), options)
+    wallSec = time.time() - startTs
+    cpu, peakRss, childPeakRss = getResourceUsage()
+    return {'wallSec': round(wallSec, 3), 'cpuSec': round(cpu - startCpu, 3),
+            'peakRssMb': round(peakRss, 1), 'childPeakRssMb': round(childPeakRss, 1)}
+
+
+def inNewProcess(func, *args):
+    """
+    Run the function in a new process, so that its peak memory is not affected by the previous runs
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def runBenchmarks(options):
+    workDir = options.workdir or tempfile.mkdtemp(prefix='zero-benchmark-')
+    results = collections.OrderedDict()
+    try:
+        for name in options.only:
+            benchDir = os.path.join(workDir, name)
+            if os.path.exists(benchDir):
+                shutil.rmtree(benchDir)
+            os.makedirs(benchDir)
+            safePrint(u'%s: generating %d records' % (name, options.size))
+            rows = inNewProcess(prepareWorker, name, benchDir, options)
+
+            best = None
+            for i in xrange(options.repeat):
+                result = inNewProcess(runWorker, name, benchDir, options)
+                if not best or result['wallSec'] < best['wallSec']:
+                    best = result
+            best['rows'] = rows
+            best['rowsPerSec'] = round(rows / max(best['wallSec'], 0.001), 1)
+            best['description'] = benchmarks[name][2]
+            results[name] = best
+            safePrint(u'%s: %.2fs, %.2fs CPU, %d rows/s, peak memory %.0f MB' % (
+                name, best['wallSec'], best['cpuSec'], best['rowsPerSec'], best['peakRssMb']))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    return {
+        'ts': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'size': options.size,
+        'seed': options.seed,
+        'processes': options.processes,
+        'benchmarks': results,
+    }
+
+
+def compareResults(results, baseline, tolerance):
+    """
+    Print the change of throughput and memory of each benchmark since the baseline
+    :return: names of the benchmarks that became slower, or use more memory, by more than the tolerance
+    """
+    regressions = []
+    if baseline['size'] != results['size'] or baseline.get('processes') != results['processes']:
+        safePrint(u'Baseline was created with size %s and %s processes, comparing anyway' % (
+            baseline['size'], baseline.get('processes')))
+    for name, res in results['benchmarks'].iteritems():
+        if name not in baseline['benchmarks']:
+            safePrint(u'%-18s no baseline' % name)
+            continue
+        base = baseline['benchmarks'][name]
+        speed = res['rowsPerSec'] / max(base['rowsPerSec'], 0.001) - 1
+        memory = res['peakRssMb'] / max(base['peakRssMb'], 0.001) - 1
+        isRegression = speed < -tolerance or memory > tolerance
+        if isRegression:
+            regressions.append(name)
+        safePrint(u'%-18s throughput %+6.1f%% (%d -> %d rows/s), peak memory %+6.1f%% (%.0f -> %.0f MB)%s' % (
+            name, speed * 100, base['rowsPerSec'], res['rowsPerSec'], memory * 100, base['peakRssMb'],
+            res['peakRssMb'], '  REGRESSION' if isRegression else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the log processing on synthetic data')
+    parser.add_argument('--size', type=int, default=100000, help='number of input records of each benchmark')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the data generators')
+    parser.add_argument('--only', default=','.join(benchmarks),
+                        help='comma separated benchmarks to run, out of ' + ', '.join(benchmarks))
+    parser.add_argument('--repeat', type=int, default=1, help='run each benchmark this many times, keep the best')
+    parser.add_argument('--processes', type=int, default=0, help='parallelProcesses setting of the pipelines')
+    parser.add_argument('--workdir', help='keep the generated data and the outputs in this directory')
+    parser.add_argument('--results', default='benchmark-results.json', help='file to save the results to')
+    parser.add_argument('--baseline', default='benchmark-baseline.json', help='results to compare to')
+    parser.add_argument('--save-baseline', action='store_true', help='also save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative throughput loss or memory growth that counts as a regression')
+    options = parser.parse_args()
+    options.only = [v.strip() for v in options.only.split(',') if v.strip()]
+    unknown = [v for v in options.only if v not in benchmarks]
+    if unknown:
+        parser.error('Unknown benchmarks: ' + ', '.join(unknown))
+    if options.workdir:
+        options.workdir = os.path.abspath(options.workdir)
+
+    results = runBenchmarks(options)
+    saveJson(options.results, results)
+    safePrint(u'Results saved to %s' % options.results)
+
+    regressions = []
+    if os.path.isfile(options.baseline):
+        regressions = compareResults(results, loadJson(options.baseline), options.tolerance)
+    if options.save_baseline:
+        saveJson(options.baseline, results)
+        safePrint(u'Baseline saved to %s' % options.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,8 @@
 # coding=utf-8
-import gzip
+import collections
+import multiprocessing
 import re
+import shutil
 import sys
 
 try:
@@ -8,6 +10,12 @@ try:
 except ImportError:
     from urllib import unquote
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 from logprocessor import *
 
 
@@ -49,6 +57,9 @@ xcsFromName = {
     'xl-axiata-indonesia': '510-11',
 }
 
+# Matches any of the partner names in the log file name
+xcsFromNameRe = re.compile('|'.join(re.escape(k) for k in sorted(xcsFromName, key=len, reverse=True)))
+
 httpStatuses = {
     '-': '',
     'hit': 'hit',
@@ -67,33 +78,65 @@ httpStatuses = {
 }
 
 
-class LogConverter(LogProcessor):
-    def __init__(self, filePattern=False, settingsFile='settings/log2dfs.json'):
-        super(LogConverter, self).__init__(settingsFile, 'w2h')
+dateRe = re.compile(r'(201\d-\d\d-\d\dT\d\d):\d\d:\d\d(\.\d+)?')
+urlRe = re.compile(r'^(https?)://([^/]+)([^?#]*)(.*)', re.IGNORECASE)
+xcsRe = re.compile(r'^[0-9]+-[0-9]+$', re.IGNORECASE)
+zeroRe = re.compile(r'zero=([^;]*)')
 
-        if not filePattern:
-            filePattern = r'\d\d\d\d\d\d\d\d'
-        self.logFileRe = re.compile(unicode(filePattern), re.IGNORECASE)
-        self.dateRe = re.compile(r'(201\d-\d\d-\d\dT\d\d):\d\d:\d\d(\.\d+)?')
-        self.urlRe = re.compile(r'^(https?)://([^/]+)([^?#]*)(.*)', re.IGNORECASE)
-        self.xcsRe = re.compile(r'^[0-9]+-[0-9]+$', re.IGNORECASE)
+# Size of the blocks of lines that are converted at once, and sent to the worker processes
+chunkSize = 4 * 1024 * 1024
 
-    def processLogFiles(self):
+hiveColumns = (u'hostname,sequence,dt,time_firstbyte,ip,cache_status,http_status,response_size,http_method,'
+               u'uri_host,uri_path,uri_query,content_type,referer,x_forwarded_for,user_agent,accept_language,'
+               u'x_analytics,webrequest_source,year,month,day,hour').split(',')
+hivePartitionColumns = hiveColumns[-4:]
+dictionaryColumns = ['hostname', 'cache_status', 'uri_host', 'x_analytics']
+outputFormats = {'tsv', 'parquet', 'both'}
+# Suffix of the directory with the columnar copy of the converted log
+columnarSuffix = '.parquet'
+# Suffix of the sidecar file with the x_analytics xcs counters of the converted log
+xcsStatsSuffix = '.xcs.json'
 
-        safePrint('Processing log files')
-        for f in os.listdir(self.pathLogs):
 
-            if not self.logFileRe.search(f):
-                continue
-            logFile = os.path.join(self.pathLogs, f)
-            statFile = os.path.join(self.pathCache, f)
-            if statFile.endswith('.gz'):
-                statFile = statFile[:-3]
+def newXcsStats():
+    """
+    Counters of the lines that already had the x_analytics xcs expected from the file name, had a different one,
+    or had none, and got the expected one added. Each counter is keyed by the xcs value, e.g. 250-99
+    """
+    return {'confirmed': collections.Counter(), 'mismatch': collections.Counter(), 'missing': collections.Counter()}
 
-            if not os.path.exists(statFile):
-                self.processLogFile(logFile, statFile)
 
-    def processLogFile(self, logFile, statFile):
+def mergeXcsStats(stats, other):
+    for k, v in other.iteritems():
+        stats[k].update(v)
+    return stats
+
+
+class LineConverter(object):
+    """
+    Converts lines of one log file into the 23-column Hive format
+    """
+
+    def __init__(self, logFile):
+        self.isTab = '.tsv' in logFile or '.tab' in logFile
+        self.webrequest_source = 'mobile'
+        self.lastDate = self.year = self.month = self.day = self.hour = None
+        self.xcsStats = newXcsStats()
+        self.diagnostics = Diagnostics(logFile)
+
+        m = xcsFromNameRe.search(logFile)
+        self.expectedXcs = xcsFromName[m.group(0)] if m else None
+        self.defaultXcs = u'zero=' + self.expectedXcs if m else None
+
+    def popXcsStats(self):
+        """
+        :return: x_analytics counters collected since the last call
+        """
+        stats = self.xcsStats
+        self.xcsStats = newXcsStats()
+        return stats
+
+    def convert(self, lines):
         """
             0  cp1046.eqiad.wmnet
             1  13866141087
@@ -112,137 +155,599 @@ class LogConverter(LogProcessor):
             .. Version/4.0 Mobile Safari/534.30
             -2 en-US
             -1 zero=410-01
-        """
 
-        safePrint('Processing %s' % logFile)
-        count = 0
-        isTab = '.tsv' in logFile or '.tab' in logFile
-        isNoOpera = 'no_opera' in logFile
-        webrequest_source = 'mobile'
-        lastDate = year = month = day = hour = None
-        xcsWarns = set()
-
-        defaultXcs = None
-        for k, v in xcsFromName.iteritems():
-            if k in logFile:
-                defaultXcs = u'zero=' + v
-                break
-
-        if logFile.endswith('.gz'):
-            streamData = io.TextIOWrapper(io.BufferedReader(gzip.open(logFile)), encoding='utf8', errors='ignore')
-        else:
-            streamData = io.open(logFile, 'r', encoding='utf8', errors='ignore')
-
-        tmpFile = statFile + '.tmp'
-        with io.open(tmpFile, 'w', encoding='utf8') as out:
-            for line in streamData:
-                count += 1
-                if count % 1000000 == 0:
-                    safePrint('%d lines processed' % count)
-
-                strip = line.strip('\n\r\x00')
-                if isTab:
-                    l = strip.split('\t')
-                    if len(l) > 2 and l[2].startswith('201'):
-                        while len(l) > 16:
-                            l[13] += ' ' + l[14]
-                            del l[11]
-                else:
-                    l = strip.split(' ')
-                    # fix text/html; charset=UTF-8 into one field
-                    while len(l) > 11 and l[10].endswith(';') and l[11] != '-' and not l[11].startswith('http'):
-                        l[10] += ' ' + l[11]
+        :type lines: list
+        :return: list of converted lines, skipping the invalid ones
+        """
+        isTab = self.isTab
+        defaultXcs = self.defaultXcs
+        expectedXcs = self.expectedXcs
+        xcsConfirmed = self.xcsStats['confirmed']
+        xcsMismatch = self.xcsStats['mismatch']
+        xcsMissing = self.xcsStats['missing']
+        webrequest_source = self.webrequest_source
+        results = []
+
+        for line in lines:
+            strip = line.strip('\n\r\x00')
+            if isTab:
+                l = strip.split('\t')
+                if len(l) > 2 and l[2].startswith('201'):
+                    while len(l) > 16:
+                        l[13] += ' ' + l[14]
                         del l[11]
-                    if len(l) == 14:
-                        l.append(u'')
-                        l.append(u'')
+            else:
+                l = strip.split(' ')
+                # fix text/html; charset=UTF-8 into one field
+                while len(l) > 11 and l[10].endswith(';') and l[11] != '-' and not l[11].startswith('http'):
+                    l[10] += ' ' + l[11]
+                    del l[11]
+                if len(l) == 14:
+                    l.append(u'')
+                    l.append(u'')
+
+            partsCount = len(l)
+            if partsCount != 16:
+                self.diagnostics.error(u'Wrong parts count', line, unicode(partsCount))
+                continue
 
-                partsCount = len(l)
-                if partsCount != 16:
-                    safePrint(u'Wrong parts count - %d parts\n%s' % (partsCount, line))
+            l = ['' if v == '-' else v.replace('\t', ' ') for v in l]
+            (hostname, sequence, dt, time_firstbyte, ip, status, response_size, http_method, uri, unknown1,
+             content_type, referer, x_forwarded_for, user_agent, accept_language, x_analytics) = l
+            # status -> cache_status, http_status
+            # uri -> uri_host, uri_path, uri_query
+            # new:  webrequest_source, year, month, day, hour
+
+            user_agent = unquote(user_agent).replace('\t', ' ')
+
+            m = dateRe.match(dt)
+            if not m:
+                self.diagnostics.error(u'Invalid date', line, dt)
+                continue
+            if self.lastDate != m.group(1):
+                self.lastDate = m.group(1)
+                d = datetime.strptime(self.lastDate, r'%Y-%m-%dT%H')
+                self.year = unicode(d.year)
+                self.month = unicode(d.month)
+                self.day = unicode(d.day)
+                self.hour = unicode(d.hour)
+
+            if xcsRe.match(x_analytics):
+                x_analytics = 'zero=' + x_analytics
+
+            if 'zero=' not in x_analytics:
+                if defaultXcs:
+                    xcsMissing[expectedXcs] += 1
+                    if x_analytics:
+                        x_analytics += ';'
+                    x_analytics += defaultXcs
+                else:
+                    self.diagnostics.error(u'String too short', line, unicode(partsCount))
                     continue
+            elif defaultXcs:
+                xcs = zeroRe.search(x_analytics).group(1)
+                if xcs != expectedXcs:
+                    xcsMismatch[xcs] += 1
+                else:
+                    xcsConfirmed[xcs] += 1
 
-                l = ['' if v == '-' else v.replace('\t', ' ') for v in l]
-                (hostname, sequence, dt, time_firstbyte, ip, status, response_size, http_method, uri, unknown1,
-                 content_type, referer, x_forwarded_for, user_agent, accept_language, x_analytics) = l
-                # status -> cache_status, http_status
-                # uri -> uri_host, uri_path, uri_query
-                # new:  webrequest_source, year, month, day, hour
+            # expand "hit/200" into "hit", "200"
+            tmp = status.split(u'/')
+            if len(tmp) != 2 or not isValidInt(tmp[1]):
+                self.diagnostics.error(u'Invalid status', line, status)
+                continue
+            (cache_status, http_status) = tmp
+            if cache_status not in httpStatuses:
+                self.diagnostics.error(u'Unknown cache_status', line, cache_status)
+                continue
+            cache_status = httpStatuses[cache_status]
 
-                user_agent = unquote(user_agent).replace('\t', ' ')
+            if uri == 'NONE://' or (http_method == 'CONNECT' and uri == ':0'):
+                uri_host = uri_path = uri_query = ''
 
-                m = self.dateRe.match(dt)
+            else:
+                m = urlRe.match(uri)
                 if not m:
-                    safePrint(u'Invalid date\n%s' % line)
-                    continue
-                if lastDate != m.group(1):
-                    lastDate = m.group(1)
-                    d = datetime.strptime(lastDate, r'%Y-%m-%dT%H')
-                    year = unicode(d.year)
-                    month = unicode(d.month)
-                    day = unicode(d.day)
-                    hour = unicode(d.hour)
-
-                if self.xcsRe.match(x_analytics):
-                    x_analytics = 'zero=' + x_analytics
-
-                if 'zero=' not in x_analytics:
-                    if defaultXcs:
-                        if x_analytics:
-                            x_analytics += ';'
-                        x_analytics += defaultXcs
-                    else:
-                        safePrint(u'String too short - %d parts\n%s' % (partsCount, line))
-                        continue
-                elif defaultXcs and x_analytics not in xcsWarns:
-                    if defaultXcs not in x_analytics:
-                        safePrint(u'Warning: XCS mismatch, expecting "%s", found "%s"' % (defaultXcs, x_analytics))
-                    else:
-                        safePrint(u'Warning: XCS confirmed, found expected "%s"' % defaultXcs)
-                    xcsWarns.add(x_analytics)
-
-                # expand "hit/200" into "hit", "200"
-                tmp = status.split(u'/')
-                if len(tmp) != 2 or not isValidInt(tmp[1]):
-                    safePrint(u'Invalid status - "%s"\n%s' % (status, line))
+                    self.diagnostics.error(u'URL parsing failed', line, uri)
                     continue
-                (cache_status, http_status) = tmp
-                if cache_status not in httpStatuses:
-                    safePrint(u'Unknown cache_status - "%s"\n%s' % (cache_status, line))
-                    continue
-                cache_status = httpStatuses[cache_status]
+                if m.group(1).lower() == u'https' and u'https=' not in x_analytics:
+                    x_analytics += u';https=1'
+                uri_host = m.group(2)
+                if uri_host.endswith(':80'):
+                    uri_host = uri_host[:-3]
+                if uri_host.endswith('.'):
+                    uri_host = uri_host[:-1]
+                uri_path = m.group(3)
+                uri_query = m.group(4)
+
+            result = '\t'.join(
+                [hostname, sequence, dt, time_firstbyte, ip, cache_status, http_status, response_size, http_method,
+                 uri_host, uri_path, uri_query, content_type, referer, x_forwarded_for, user_agent, accept_language,
+                 x_analytics, webrequest_source, self.year, self.month, self.day, self.hour])
+            results.append(result + '\n')
+
+        return results
+
+
+nonAsciiRe = re.compile(r'[\x80-\xff]')
 
-                if uri == 'NONE://' or (http_method == 'CONNECT' and uri == ':0'):
-                    uri_host = uri_path = uri_query = ''
 
+def isValidIntBytes(val):
+    # unicode int() also accepts non-ascii digits and whitespace, only try it if the fast check fails
+    return isValidInt(val) or isValidInt(val.decode('utf8'))
+
+
+class BytesLineConverter(LineConverter):
+    """
+    Same conversion as LineConverter, but works on the raw utf8 bytes of the lines, without decoding them.
+    Produces byte-identical output to LineConverter writing its results as utf8.
+    """
+
+    def __init__(self, logFile):
+        super(BytesLineConverter, self).__init__(logFile)
+        if self.defaultXcs:
+            self.expectedXcs = self.expectedXcs.encode('utf8')
+            self.defaultXcs = self.defaultXcs.encode('utf8')
+
+    def convert(self, lines):
+        """
+        :type lines: list
+        :return: list of converted utf8 lines, skipping the invalid ones
+        """
+        isTab = self.isTab
+        defaultXcs = self.defaultXcs
+        expectedXcs = self.expectedXcs
+        xcsConfirmed = self.xcsStats['confirmed']
+        xcsMismatch = self.xcsStats['mismatch']
+        xcsMissing = self.xcsStats['missing']
+        webrequest_source = self.webrequest_source
+        results = []
+
+        for line in self.splitLines(lines):
+            strip = line.strip('\n\r\x00')
+            if isTab:
+                l = strip.split('\t')
+                if len(l) > 2 and l[2].startswith('201'):
+                    while len(l) > 16:
+                        l[13] += ' ' + l[14]
+                        del l[11]
+            else:
+                l = strip.split(' ')
+                # fix text/html; charset=UTF-8 into one field - find where it ends, and join it once
+                last = 10
+                partsCount = len(l)
+                while last + 1 < partsCount and l[last].endswith(';') and l[last + 1] != '-' \
+                        and not l[last + 1].startswith('http'):
+                    last += 1
+                if last > 10:
+                    l[10:last + 1] = [' '.join(l[10:last + 1])]
+                if len(l) == 14:
+                    l.append('')
+                    l.append('')
+
+            partsCount = len(l)
+            if partsCount != 16:
+                self.diagnostics.error(u'Wrong parts count', line, unicode(partsCount))
+                continue
+
+            # Tab-separated fields cannot contain tabs
+            if not isTab and '\t' in strip:
+                l = ['' if v == '-' else v.replace('\t', ' ') for v in l]
+            else:
+                l = ['' if v == '-' else v for v in l]
+            (hostname, sequence, dt, time_firstbyte, ip, status, response_size, http_method, uri, unknown1,
+             content_type, referer, x_forwarded_for, user_agent, accept_language, x_analytics) = l
+
+            if '%' in user_agent:
+                ua = unquote(user_agent)
+                if nonAsciiRe.search(ua):
+                    # unquote() of unicode treats %XX as latin1 characters
+                    ua = unquote(user_agent.decode('utf8')).encode('utf8')
+                user_agent = ua.replace('\t', ' ')
+
+            m = dateRe.match(dt)
+            if not m:
+                self.diagnostics.error(u'Invalid date', line, dt)
+                continue
+            if self.lastDate != m.group(1):
+                self.lastDate = m.group(1)
+                d = datetime.strptime(self.lastDate, r'%Y-%m-%dT%H')
+                self.year = str(d.year)
+                self.month = str(d.month)
+                self.day = str(d.day)
+                self.hour = str(d.hour)
+
+            if xcsRe.match(x_analytics):
+                x_analytics = 'zero=' + x_analytics
+
+            if 'zero=' not in x_analytics:
+                if defaultXcs:
+                    xcsMissing[expectedXcs] += 1
+                    if x_analytics:
+                        x_analytics += ';'
+                    x_analytics += defaultXcs
+                else:
+                    self.diagnostics.error(u'String too short', line, unicode(partsCount))
+                    continue
+            elif defaultXcs:
+                xcs = zeroRe.search(x_analytics).group(1)
+                if xcs != expectedXcs:
+                    xcsMismatch[xcs] += 1
                 else:
-                    m = self.urlRe.match(uri)
-                    if not m:
-                        safePrint(u'URL parsing failed: "%s"\n%s' % (uri, line))
-                        continue
-                    if m.group(1).lower() == u'https' and u'https=' not in x_analytics:
-                        x_analytics += u';https=1'
-                    uri_host = m.group(2)
-                    if uri_host.endswith(':80'):
-                        uri_host = uri_host[:-3]
-                    if uri_host.endswith('.'):
-                        uri_host = uri_host[:-1]
-                    uri_path = m.group(3)
-                    uri_query = m.group(4)
-
-                result = '\t'.join(
-                    [hostname, sequence, dt, time_firstbyte, ip, cache_status, http_status, response_size, http_method,
-                     uri_host, uri_path, uri_query, content_type, referer, x_forwarded_for, user_agent, accept_language,
-                     x_analytics, webrequest_source, year, month, day, hour])
-                out.write(result + '\n')
+                    xcsConfirmed[xcs] += 1
+
+            # expand "hit/200" into "hit", "200"
+            tmp = status.split('/')
+            if len(tmp) != 2 or not isValidIntBytes(tmp[1]):
+                self.diagnostics.error(u'Invalid status', line, status)
+                continue
+            (cache_status, http_status) = tmp
+            if cache_status not in httpStatuses:
+                self.diagnostics.error(u'Unknown cache_status', line, cache_status)
+                continue
+            cache_status = httpStatuses[cache_status]
+
+            if uri == 'NONE://' or (http_method == 'CONNECT' and uri == ':0'):
+                uri_host = uri_path = uri_query = ''
+
+            else:
+                m = urlRe.match(uri)
+                if not m:
+                    self.diagnostics.error(u'URL parsing failed', line, uri)
+                    continue
+                if m.group(1).lower() == 'https' and 'https=' not in x_analytics:
+                    x_analytics += ';https=1'
+                uri_host = m.group(2)
+                if uri_host.endswith(':80'):
+                    uri_host = uri_host[:-3]
+                if uri_host.endswith('.'):
+                    uri_host = uri_host[:-1]
+                uri_path = m.group(3)
+                uri_query = m.group(4)
+
+            result = '\t'.join(
+                [hostname, sequence, dt, time_firstbyte, ip, cache_status, http_status, response_size, http_method,
+                 uri_host, uri_path, uri_query, content_type, referer, x_forwarded_for, user_agent, accept_language,
+                 x_analytics, webrequest_source, self.year, self.month, self.day, self.hour])
+            results.append(result + '\n')
+
+        return results
+
+    @staticmethod
+    def splitLines(lines):
+        """
+        Make the raw lines look like the ones read in text mode - drop invalid utf8, and split on \r as well
+        """
+        for line in lines:
+            if nonAsciiRe.search(line):
+                line = line.decode('utf8', 'ignore').encode('utf8')
+            if '\r' in line:
+                for l in line.splitlines(True):
+                    yield l
+            else:
+                yield line
+
+
+class ColumnarWriter(object):
+    """
+    Writes converted lines as snappy-compressed parquet files, in the year=/month=/day=/hour= partition directories.
+    Files are created in a temporary directory, which is renamed to the destination on close()
+    """
+
+    def __init__(self, path, rowGroupSize=100000):
+        """
+        :param rowGroupSize: maximum number of rows buffered across all partitions. When it is reached,
+            the partition with the most buffered rows is written as a row group.
+        """
+        self.path = path
+        self.tmpPath = path + '.tmp'
+        self.rowGroupSize = rowGroupSize
+        self.columns = hiveColumns[:-len(hivePartitionColumns)]
+        self.schema = pyarrow.schema([pyarrow.field(c, pyarrow.string()) for c in self.columns])
+        # partition values -> list of buffered rows
+        self.rows = {}
+        self.bufferedRows = 0
+        # partition values -> parquet writer
+        self.writers = {}
+        if os.path.exists(self.tmpPath):
+            shutil.rmtree(self.tmpPath)
+        os.makedirs(self.tmpPath)
+
+    def writelines(self, lines):
+        partCount = len(hivePartitionColumns)
+        rows = self.rows
+        for line in lines:
+            values = line.rstrip('\n').split('\t')
+            key = tuple(values[-partCount:])
+            if key in rows:
+                rows[key].append(values[:-partCount])
+            else:
+                rows[key] = [values[:-partCount]]
+            self.bufferedRows += 1
+            if self.bufferedRows >= self.rowGroupSize:
+                self._flush(max(rows, key=lambda k: len(rows[k])))
+
+    def _flush(self, key):
+        rows = self.rows.pop(key)
+        self.bufferedRows -= len(rows)
+        columns = zip(*rows)
+        table = pyarrow.Table.from_arrays([pyarrow.array(col, type=pyarrow.string()) for col in columns],
+                                          names=self.columns)
+        if key in self.writers:
+            writer = self.writers[key]
+        else:
+            path = os.path.join(self.tmpPath, *[u'%s=%s' % v for v in zip(hivePartitionColumns, key)])
+            os.makedirs(path)
+            writer = pyarrow.parquet.ParquetWriter(os.path.join(path, 'part-00000.parquet'), self.schema,
+                                                   compression='snappy', use_dictionary=dictionaryColumns)
+            self.writers[key] = writer
+        writer.write_table(table)
+
+    def close(self):
+        for key in list(self.rows):
+            self._flush(key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmpPath, self.path)
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.rows = {}
+        self.bufferedRows = 0
+        shutil.rmtree(self.tmpPath, ignore_errors=True)
+
+
+def compareColumnar(statFile):
+    """
+    Read the columnar copy of a converted log back, and compare its rows with the TSV file, partition by partition
+    :return: number of rows compared
+    """
+    partCount = len(hivePartitionColumns)
+    expected = collections.defaultdict(list)
+    with io.open(statFile, 'rb') as f:
+        for line in f:
+            values = line.rstrip('\n').decode('utf8').split(u'\t')
+            expected[tuple(values[-partCount:])].append(tuple(values[:-partCount]))
+
+    columns = hiveColumns[:-partCount]
+    path = statFile + columnarSuffix
+    count = 0
+    for dirPath, dirs, files in os.walk(path):
+        for f in files:
+            if not f.endswith('.parquet'):
+                continue
+            key = tuple(unicode(v.split('=', 1)[1]) for v in os.path.relpath(dirPath, path).split(os.sep))
+            table = pyarrow.parquet.read_table(os.path.join(dirPath, f))
+            rows = zip(*[table.column(c).to_pylist() for c in columns])
+            expectedRows = expected.pop(key, [])
+            if rows != expectedRows:
+                if len(rows) != len(expectedRows):
+                    raise ValueError('Partition %s of %s has %d rows, expecting %d' % (
+                        joinValues(key), path, len(rows), len(expectedRows)))
+                pos = next(i for i, (a, b) in enumerate(zip(rows, expectedRows)) if a != b)
+                raise ValueError('Row %d of partition %s of %s differs from the TSV file: %s' % (
+                    pos, joinValues(key), path, joinValues(rows[pos])))
+            count += len(rows)
+    if expected:
+        raise ValueError('Partitions %s are missing in %s' % (
+            joinValues([joinValues(k) for k in sorted(expected)]), path))
+    return count
+
+
+# Converters of the worker process, reused between the chunks of the same file
+workerConverters = {}
+
+
+def convertChunk(args):
+    """
+    Multiprocessing worker - convert a block of lines of the log file
+    :return: converted lines, the xcs counters and the diagnostics of the block
+    """
+    logFile, lines, parseBytes = args
+    if logFile not in workerConverters:
+        workerConverters.clear()
+        workerConverters[logFile] = (BytesLineConverter if parseBytes else LineConverter)(logFile)
+    converter = workerConverters[logFile]
+    return converter.convert(lines), converter.popXcsStats(), converter.diagnostics.pop()
+
+
+def convertLogFile(logFile, statFile, pool=None, processes=0, parseBytes=False, outputFormat='tsv',
+                   diagnostics=None):
+    """
+    Convert one log file into the Hive format file, and return the number of lines read
+    :param pool: if given, blocks of lines are converted by the pool's worker processes, in order
+    :param parseBytes: parse the raw bytes of the file with BytesLineConverter instead of decoding it
+    :param outputFormat: 'tsv' to write statFile, 'parquet' to write the statFile + columnarSuffix directory, or 'both'
+    :type diagnostics: Diagnostics
+    """
+    safePrint('Processing %s' % logFile)
+    count = 0
+    tmpFile = statFile + '.tmp'
+
+    if diagnostics is None:
+        diagnostics = Diagnostics(logFile)
+    diagnostics.totalBytes = os.path.getsize(logFile)
+    diagnostics.begin()
+
+    streamData, rawFile = openLogFile(logFile, parseBytes)
+    converter = (BytesLineConverter if parseBytes else LineConverter)(logFile)
+    converter.diagnostics = diagnostics
+
+    writers = []
+    if outputFormat != 'parquet':
+        writers.append(io.open(tmpFile, 'wb') if parseBytes else io.open(tmpFile, 'w', encoding='utf8'))
+    columnar = ColumnarWriter(statFile + columnarSuffix) if outputFormat != 'tsv' else None
+    if columnar:
+        writers.append(columnar)
+
+    def write(results):
+        for writer in writers:
+            writer.writelines(results)
+
+    xcsStats = newXcsStats()
+
+    def writeChunk(chunkResult):
+        results, stats, chunkDiagnostics = chunkResult
+        mergeXcsStats(xcsStats, stats)
+        diagnostics.merge(chunkDiagnostics)
+        write(results)
+
+    # Results of the chunks sent to the pool, in the file order
+    pending = collections.deque()
 
+    try:
+        with streamData, rawFile:
+            while True:
+                lines = streamData.readlines(chunkSize)
+                if not lines:
+                    break
+                count += len(lines)
+                diagnostics.progress(count, rawFile.tell())
+
+                if pool:
+                    pending.append(pool.apply_async(convertChunk, ((logFile, lines, parseBytes),)))
+                    # Do not read the whole file into memory if the workers are slower than the reader
+                    while len(pending) > processes * 2:
+                        writeChunk(pending.popleft().get())
+                else:
+                    write(converter.convert(lines))
+            while pending:
+                writeChunk(pending.popleft().get())
+    except:
+        for writer in writers:
+            if writer is columnar:
+                columnar.abort()
+            else:
+                writer.close()
+        raise
+
+    for writer in writers:
+        writer.close()
+
+    if outputFormat != 'parquet':
         if os.path.exists(statFile):
             os.remove(statFile)
         os.rename(tmpFile, statFile)
 
+    diagnostics.report()
+    mergeXcsStats(xcsStats, converter.popXcsStats())
+    saveXcsStats(statFile + xcsStatsSuffix, converter.expectedXcs, xcsStats)
+    return count
+
+
+def saveXcsStats(filename, expectedXcs, xcsStats):
+    """
+    Write the sidecar file with the xcs counters of the log file, and print their totals
+    """
+    data = dict(xcsStats)
+    data['expected'] = expectedXcs
+    saveJson(filename, data)
+    if expectedXcs:
+        # expectedXcs is always ascii, but the values found in the bytes-parsed logs may not be
+        safePrint(u'XCS "%s": %d confirmed, %d mismatched, %d missing' % (
+            expectedXcs, sum(xcsStats['confirmed'].values()), sum(xcsStats['mismatch'].values()),
+            sum(xcsStats['missing'].values())))
+        for xcs, count in xcsStats['mismatch'].most_common(5):
+            if isinstance(xcs, str):
+                xcs = xcs.decode('utf8')
+            safePrint(u'Warning: XCS mismatch, expecting "%s", found "%s" %d times' % (expectedXcs, xcs, count))
+
+
+def convertLogFileWorker(args):
+    """
+    Multiprocessing worker - convert the whole log file
+    """
+    logFile, statFile, parseBytes, outputFormat, diagnostics = args
+    return convertLogFile(logFile, statFile, parseBytes=parseBytes, outputFormat=outputFormat,
+                          diagnostics=diagnostics)
+
+
+class LogConverter(LogProcessor):
+    def __init__(self, filePattern=False, settingsFile='settings/log2dfs.json'):
+        super(LogConverter, self).__init__(settingsFile, 'w2h')
+
+        if not filePattern:
+            filePattern = r'\d\d\d\d\d\d\d\d'
+        self.logFileRe = re.compile(unicode(filePattern), re.IGNORECASE)
+
+        if self.settings.outputFormat not in outputFormats:
+            raise ValueError('Unknown outputFormat "%s", expecting one of %s' % (
+                self.settings.outputFormat, ', '.join(sorted(outputFormats))))
+        if self.settings.outputFormat != 'tsv' and not pyarrow:
+            raise ValueError('pyarrow module is required for the "%s" outputFormat' % self.settings.outputFormat)
+
+    def defaultSettings(self, suffix):
+        s = super(LogConverter, self).defaultSettings(suffix)
+        s.outputFormat = 'tsv'
+        s.parseBytes = False
+        # With the 'both' outputFormat, read each columnar file back and compare it with the TSV file
+        s.verifyColumnar = False
+        return s
+
+    def processLogFiles(self):
+
+        safePrint('Processing log files')
+        files = []
+        for f in os.listdir(self.pathLogs):
+
+            if not self.logFileRe.search(f):
+                continue
+            logFile = os.path.join(self.pathLogs, f)
+            statFile = os.path.join(self.pathCache, f)
+            if statFile.endswith('.gz'):
+                statFile = statFile[:-3]
+
+            if not all(os.path.exists(p) for p in self.getOutputPaths(statFile)):
+                files.append((logFile, statFile, self.settings.parseBytes, self.settings.outputFormat,
+                              self.createDiagnostics(logFile)))
+
+        processes = self.settings.parallelProcesses
+        if processes > 1 and files:
+            pool = multiprocessing.Pool(processes)
+            try:
+                if len(files) >= processes:
+                    # Enough files to keep all workers busy, convert each file in its own worker
+                    for count in pool.imap_unordered(convertLogFileWorker, files):
+                        self.addStageRows(count)
+                else:
+                    # Split each file into blocks of lines, and convert them in parallel
+                    for logFile, statFile, parseBytes, outputFormat, diagnostics in files:
+                        self.addStageRows(convertLogFile(
+                            logFile, statFile, pool, processes, parseBytes, outputFormat, diagnostics))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for logFile, statFile, _, _, _ in files:
+                self.processLogFile(logFile, statFile)
+
+        if self.settings.verifyColumnar and self.settings.outputFormat == 'both':
+            for logFile, statFile, _, _, _ in files:
+                safePrint('Verified %d rows of %s' % (compareColumnar(statFile), statFile + columnarSuffix))
+
+    def getOutputPaths(self, statFile):
+        outputFormat = self.settings.outputFormat
+        paths = []
+        if outputFormat != 'parquet':
+            paths.append(statFile)
+        if outputFormat != 'tsv':
+            paths.append(statFile + columnarSuffix)
+        return paths
+
+    def processLogFile(self, logFile, statFile):
+        self.addStageRows(convertLogFile(logFile, statFile, parseBytes=self.settings.parseBytes,
+                                         outputFormat=self.settings.outputFormat,
+                                         diagnostics=self.createDiagnostics(logFile)))
 
     def run(self):
-        self.processLogFiles()
+        with self.stage('processLogFiles'):
+            self.processLogFiles()
 
     def manualRun(self):
         self.processLogFiles()
@@ -1,15 +1,26 @@
+import collections
+import contextlib
 import csv
 from datetime import datetime
+import gzip
 import io
 import json
 import os
+import signal
+import sys
+import time
 import traceback
 
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows
+
 from unidecode import unidecode
 
 from api import AttrDict
 import api
-from utils import CsvUnicodeWriter, CsvUnicodeReader
+from utils import CsvUnicodeWriter, CsvUnicodeReader, decodeRows
 
 
 validSites = {
@@ -35,42 +46,237 @@ def joinValues(vals):
     return u','.join([unicode(v) for v in vals])
 
 
+def toUnicodeRows(data, colCount, filename):
+    for vals in data:
+        if 0 < colCount != len(vals):
+            raise ValueError(u'Value should have %d columns, not %d for file %s\n%s' %
+                             (colCount, len(vals), filename, joinValues(vals)))
+        yield [v if type(v) is unicode else unicode(v) for v in vals]
+
+
 def writeData(filename, data, header, delimiter='\t'):
     colCount = len(header)
     tmpFile = filename + '.tmp'
     with CsvUnicodeWriter(tmpFile, csv.excel, delimiter=delimiter) as out:
         out.writerow(header)
-        for vals in data:
-            if 0 < colCount != len(vals):
-                raise ValueError(u'Value should have %d columns, not %d for file %s\n%s' %
-                                 (colCount, len(vals), filename, joinValues(vals)))
-            out.writerow([unicode(v) for v in vals])
+        out.writerows(toUnicodeRows(data, colCount, filename))
     if os.path.exists(filename):
         os.remove(filename)
     os.rename(tmpFile, filename)
 
 
-def readData(filename, colCount=0, delimiter='\t'):
+def readData(filename, colCount=0, delimiter='\t', intColumns=None, schema=None, columns=None, filters=None,
+             asArrays=False, repairRow=None):
     """
     :type filename str|unicode
     :type colCount int|list
     :type separator str|unidecode:
+    :param intColumns: indexes of the columns to return as int, e.g. [-1] for the count column
+    :param schema: list of column names, or of (name, type) tuples such as (u'count', int). Untyped columns
+        are unicode. If colCount is a list of names, it is used as the schema by default.
+    :param columns: names of the columns to return. When schema, columns or filters are given, each row is
+        returned as a tuple of these columns (all of the schema by default), converted to their types.
+    :param filters: {name: (min, max)} - only return rows where min <= value < max, either bound may be None.
+        Rows are filtered before they are decoded.
+    :param asArrays: instead of tuples, yield NumPy record arrays, one per block of rows
+    :param repairRow: function(vals) called with the undecoded values of a row that does not have colCount
+        columns, before the schema is applied. Returns the fixed values, or None to fail on that row.
     :return:
     """
+    typed = schema is not None or columns is not None or filters is not None or asArrays
     if type(colCount) is list:
+        if schema is None:
+            schema = colCount
         colCount = len(colCount)
-    skipFirst = colCount > 0
-    if not skipFirst:
+    elif colCount == 0 and schema is not None:
+        colCount = -len(schema)
+    hasHeader = colCount > 0
+    if not hasHeader:
         colCount = -colCount
-    with CsvUnicodeReader(filename, delimiter=delimiter) as inp:
-        for vals in inp:
-            if 0 < colCount != len(vals):
-                raise ValueError('This value should have %d columns, not %d: %s in file %s' %
-                                 (colCount, len(vals), joinValues(vals), filename))
-            if skipFirst:
-                skipFirst = False
+    if not typed:
+        return readRows(filename, colCount, hasHeader, delimiter, intColumns)
+    if schema is None:
+        raise ValueError('Column names are needed to read typed data from %s' % filename)
+    return readTypedRows(filename, colCount, hasHeader, delimiter, schema, columns, filters, asArrays, repairRow)
+
+
+def checkColumnCount(filename, colCount, vals):
+    if 0 < colCount != len(vals):
+        raise ValueError('This value should have %d columns, not %d: %s in file %s' %
+                         (colCount, len(vals), joinValues(vals), filename))
+
+
+def readRows(filename, colCount, hasHeader, delimiter, intColumns):
+    with CsvUnicodeReader(filename, delimiter=delimiter, header=hasHeader) as inp:
+        if inp.header is not None:
+            checkColumnCount(filename, colCount, inp.header)
+        while True:
+            rows = inp.readrows()
+            if not rows:
+                break
+            for vals in rows:
+                if 0 < colCount != len(vals):
+                    checkColumnCount(filename, colCount, vals)
+                if intColumns:
+                    # Only converted once the row is known to have the right columns
+                    for col in intColumns:
+                        vals[col] = int(vals[col])
+                yield vals
+
+
+# Types that are parsed directly from the undecoded value
+rawTypes = {int, long, float}
+
+
+def filterRows(rows, index, parse, minValue, maxValue):
+    if parse is not None:
+        if minValue is not None and maxValue is not None:
+            return [r for r in rows if minValue <= parse(r[index]) < maxValue]
+        elif minValue is not None:
+            return [r for r in rows if minValue <= parse(r[index])]
+        return [r for r in rows if parse(r[index]) < maxValue]
+    if minValue is not None and maxValue is not None:
+        return [r for r in rows if minValue <= r[index] < maxValue]
+    elif minValue is not None:
+        return [r for r in rows if minValue <= r[index]]
+    return [r for r in rows if r[index] < maxValue]
+
+
+def readTypedRows(filename, colCount, hasHeader, delimiter, schema, columns, filters, asArrays, repairRow):
+    names = []
+    types = {}
+    for col in schema:
+        name, typ = (col, unicode) if isinstance(col, basestring) else col
+        names.append(name)
+        types[name] = typ
+    if columns is None:
+        columns = names
+    unknown = [c for c in list(columns) + list(filters or []) if c not in types]
+    if unknown:
+        raise ValueError('Unknown columns %s for file %s' % (joinValues(unknown), filename))
+    indexes = [names.index(c) for c in columns]
+
+    # Strings are compared as utf-8 bytes, which sort in the same order as the unicode strings
+    rowFilters = []
+    for name, (minValue, maxValue) in (filters or {}).iteritems():
+        if minValue is None and maxValue is None:
+            continue
+        typ = types[name]
+        if typ is unicode:
+            parse = None
+            minValue, maxValue = [v.encode('utf-8') if isinstance(v, unicode) else v for v in (minValue, maxValue)]
+        elif typ in rawTypes:
+            parse = typ
+        else:
+            parse = lambda v, typ=typ: typ(v.decode('utf-8'))
+        rowFilters.append((names.index(name), parse, minValue, maxValue))
+
+    if asArrays:
+        import numpy as np
+
+    with CsvUnicodeReader(filename, delimiter=delimiter, header=hasHeader) as inp:
+        if inp.header is not None:
+            checkColumnCount(filename, colCount, inp.header)
+        while True:
+            rows = inp.readRawRows()
+            if not rows:
+                break
+            if colCount > 0:
+                for i, vals in enumerate(rows):
+                    if colCount != len(vals):
+                        fixed = repairRow(vals) if repairRow else None
+                        if fixed is None or colCount != len(fixed):
+                            checkColumnCount(filename, colCount, decodeRows([vals], 'utf-8')[0])
+                        rows[i] = fixed
+            for rowFilter in rowFilters:
+                rows = filterRows(rows, *rowFilter)
+            if not rows:
                 continue
-            yield vals
+            values = []
+            for name, index in zip(columns, indexes):
+                typ = types[name]
+                col = [r[index] for r in rows]
+                if typ in rawTypes:
+                    col = map(typ, col)
+                else:
+                    col = decodeRows([col], 'utf-8')[0]
+                    if typ is not unicode:
+                        col = map(typ, col)
+                values.append(col)
+            if asArrays:
+                yield np.rec.fromarrays([np.array(v, dtype=object if types[n] is unicode else None)
+                                         for n, v in zip(columns, values)], names=[str(n) for n in columns])
+            else:
+                for vals in zip(*values):
+                    yield vals
+
+
+# Replaces missing values in the aggregation keys, because groupby() drops the rows with a NaN key
+missingKey = u'\x00'
+
+
+def readAggregatedTable(filename, keyColumns, rowFilter=None, chunkRows=1000000, valueColumn='count', naFilter=True):
+    """
+    Load a large TSV file in chunks, summing valueColumn by keyColumns. Only one chunk and the aggregate are
+    kept in memory. The string columns are read as categories, and each chunk is filtered and aggregated
+    before it is merged into the total.
+    :param rowFilter: function(chunk) returning a boolean mask of the rows to keep
+    :return: DataFrame with keyColumns and valueColumn, with the keys in the order they first appear in the file
+    """
+    from pandas import read_table, concat, DataFrame
+    import numpy as np
+
+    with io.open(filename, 'rb') as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+    dtype = dict((col, 'category') for col in header if col != valueColumn)
+
+    if chunkRows:
+        chunks = read_table(filename, sep='\t', dtype=dtype, na_filter=naFilter, chunksize=chunkRows)
+    else:
+        chunks = [read_table(filename, sep='\t', dtype=dtype, na_filter=naFilter)]
+    total = None
+    for chunk in chunks:
+        if rowFilter is not None:
+            chunk = chunk[rowFilter(chunk)]
+        if not len(chunk):
+            continue
+        # Group by the category codes - grouping by categorical columns would create all possible combinations
+        sums = chunk[valueColumn].groupby([chunk[col].cat.codes for col in keyColumns], sort=False).sum()
+        part = DataFrame()
+        for i, col in enumerate(keyColumns):
+            codes = sums.index.get_level_values(i) if len(keyColumns) > 1 else sums.index
+            categories = np.append(chunk[col].cat.categories.values.astype(object), np.array([missingKey], object))
+            # code -1 is a missing value, which takes the last item - missingKey
+            part[col] = categories.take(codes)
+        part[valueColumn] = sums.values
+        if total is not None:
+            part = concat([total, part], ignore_index=True)
+        total = part.groupby(keyColumns, sort=False, as_index=False)[valueColumn].sum()
+
+    if total is None:
+        return DataFrame(columns=list(keyColumns) + [valueColumn])
+    for col in keyColumns:
+        total.loc[total[col] == missingKey, col] = np.nan
+    return total
+
+
+def loadJson(filename, default=None):
+    """
+    :return: parsed content of the JSON file, or default if the file does not exist
+    """
+    if not os.path.isfile(filename):
+        return default
+    with io.open(filename, 'rb') as f:
+        return json.load(f)
+
+
+def saveJson(filename, data):
+    tmpFile = filename + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        json.dump(data, f, indent=True, sort_keys=True)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpFile, filename)
 
 
 def update(a, b):
@@ -83,14 +289,196 @@ def update(a, b):
     return a
 
 
+def openLogFile(filename, binary=False):
+    """
+    Open a plain or gzipped log file for reading, decoding it as utf8 unless binary is set
+    :return: the stream, and the underlying file, whose tell() is the position in the file on disk
+    """
+    raw = io.open(filename, 'rb')
+    stream = io.BufferedReader(gzip.GzipFile(fileobj=raw)) if filename.endswith('.gz') else raw
+    if not binary:
+        stream = io.TextIOWrapper(stream, encoding='utf8', errors='ignore')
+    return stream, raw
+
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Diagnostics(object):
+    """
+    Counts the malformed lines per error class, keeping only a few of them as examples,
+    and prints the processing throughput at most every reportInterval seconds.
+    Instances can be pickled, and the ones collected by the worker processes merged into one.
+    """
+
+    def __init__(self, name=u'', totalBytes=0, reportInterval=30, sampleSize=5):
+        self.name = name
+        self.totalBytes = totalBytes
+        self.reportInterval = reportInterval
+        self.sampleSize = sampleSize
+        # error class -> number of lines
+        self.errors = collections.Counter()
+        # error class -> list of (detail, line)
+        self.samples = {}
+        self.lines = 0
+        self.bytes = 0
+        self.begin()
+
+    def begin(self):
+        self.startTs = self.lastReportTs = time.time()
+
+    def error(self, errorClass, line, detail=u''):
+        """
+        :param errorClass: short description of the problem, e.g. u'Invalid status'
+        :param line: the offending line, unicode or utf8 bytes
+        :param detail: the offending value, unicode or utf8 bytes
+        """
+        self.errors[errorClass] += 1
+        if errorClass in self.samples:
+            samples = self.samples[errorClass]
+            if len(samples) < self.sampleSize:
+                samples.append((detail, line))
+        else:
+            self.samples[errorClass] = [(detail, line)]
+
+    def progress(self, lines, bytes):
+        """
+        Report the total number of lines and bytes processed so far
+        """
+        self.lines = lines
+        self.bytes = bytes
+        now = time.time()
+        if now - self.lastReportTs >= self.reportInterval:
+            self.lastReportTs = now
+            safePrint(self.formatProgress(now))
+
+    def formatProgress(self, now=None):
+        elapsed = max((now or time.time()) - self.startTs, 0.001)
+        msg = u'%s%d lines, %d lines/s, %.2f MB/s' % (
+            self.name + u': ' if self.name else u'', self.lines, self.lines / elapsed,
+            self.bytes / elapsed / 1024 / 1024)
+        if self.errors:
+            msg += u', %d errors' % sum(self.errors.values())
+        if 0 < self.bytes < self.totalBytes:
+            msg += u', ETA %s' % formatDuration(elapsed * (self.totalBytes - self.bytes) / self.bytes)
+        return msg
+
+    def pop(self):
+        """
+        :return: Diagnostics with the errors collected since the last call, and reset them
+        """
+        result = Diagnostics(self.name, sampleSize=self.sampleSize)
+        result.errors, result.samples = self.errors, self.samples
+        self.errors, self.samples = collections.Counter(), {}
+        return result
+
+    def merge(self, other):
+        """
+        Add the errors of another Diagnostics object, e.g. the one returned by a worker process
+        """
+        self.errors.update(other.errors)
+        for errorClass, samples in other.samples.iteritems():
+            own = self.samples.setdefault(errorClass, [])
+            own.extend(samples[:self.sampleSize - len(own)])
+        return self
+
+    def report(self):
+        """
+        Print the final throughput, and the error counters with their examples
+        """
+        safePrint(self.formatProgress())
+        for errorClass, count in sorted(self.errors.iteritems(), key=lambda v: -v[1]):
+            safePrint(u'%s - %d lines, for example:' % (errorClass, count))
+            for detail, line in self.samples.get(errorClass, []):
+                if isinstance(detail, str):
+                    detail = detail.decode('utf8', 'replace')
+                if isinstance(line, str):
+                    line = line.decode('utf8', 'replace')
+                safePrint((u'  "%s"  ' % detail if detail else u'  ') + line.rstrip(u'\r\n'))
+
+
+def getResourceUsage():
+    """
+    :return: CPU seconds used by this process and its finished child processes,
+             and the peak resident memory in MB of this process, and of its largest child process
+    """
+    if not resource:
+        t = os.times()
+        return t[0] + t[1] + t[2] + t[3], 0, 0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on Mac, and in kilobytes elsewhere
+    scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    return (own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            own.ru_maxrss / scale, children.ru_maxrss / scale)
+
+
+def getCurrentRss():
+    """
+    :return: current resident memory of this process in MB, or None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024)
+    except (EnvironmentError, ValueError, AttributeError):
+        return None
+
+
+# Environment variable that overrides the profiler setting, e.g. ZERO_PROFILE=sampling python smslogs.py
+profilerEnvVar = 'ZERO_PROFILE'
+
+
+class SamplingProfiler(object):
+    """
+    Low overhead statistical profiler - records the stack of the main thread every interval seconds of CPU time.
+    Saves them in the collapsed stacks format of flamegraph.pl. Needs signal.setitimer, i.e. not Windows.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # 'file:function:line;...' from the outermost frame -> number of samples
+        self.stacks = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[';'.join(stack)] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        # Restart the system calls interrupted by the timer instead of failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def save(self, filename):
+        with io.open(filename, 'wb') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+
+
 class ScriptProcessor(object):
     def __init__(self, settingsFile, pathSuffix):
 
         self._wiki = None
         self.dateFormat = '%Y-%m-%d'
         self.dateTimeFormat = '%Y-%m-%d %H:%M:%S'
+        # Completed stages of the current run, and the ones still running, innermost last
+        self.stages = []
+        self._activeStages = []
 
         self.settingsFile = self.normalizePath(settingsFile, False)
+        self.runHistoryFile = os.path.splitext(self.settingsFile)[0] + '.history.jsonl'
+        self.profileDir = os.path.dirname(self.settingsFile)
 
         settings = self.defaultSettings(pathSuffix)
         if os.path.isfile(self.settingsFile):
@@ -174,6 +562,9 @@ class ScriptProcessor(object):
         s.smtpTo = False
         s.proxy = False
         s.proxyPort = 0
+        # Profile the runs - '', 'cprofile' or 'sampling'. Can be overridden with the ZERO_PROFILE environment variable
+        s.profiler = ''
+        s.profilerInterval = 0.005
         return s
 
     def onSavingSettings(self):
@@ -200,16 +591,118 @@ class ScriptProcessor(object):
     def parseDate(self, value, dateFormat):
         return datetime.strptime(str(value), dateFormat) if isinstance(value, basestring) else value
 
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure a step of the run - wall and CPU time, memory, and the rows reported with addStageRows().
+        The stages are saved to the run history by safeRun()
+            with self.stage('combineStats'):
+                ...
+        Memory is recorded as:
+            startRssMb - resident memory when the stage started
+            processPeakRssMb - peak resident memory of the process so far, possibly reached by an earlier stage
+            peakRssMb - peak reached during this stage, or None if the memory stayed below the earlier peak
+            childPeakRssMb - same as peakRssMb, for the largest finished child process
+        """
+        st = AttrDict(name=name, ok=False, rows=None)
+        self._activeStages.append(st)
+        startTs = time.time()
+        startCpu, startPeakRss, startChildPeakRss = getResourceUsage()
+        startRss = getCurrentRss()
+        try:
+            yield st
+            st.ok = True
+        finally:
+            self._activeStages.pop()
+            cpu, peakRss, childPeakRss = getResourceUsage()
+            st.wallSec = round(time.time() - startTs, 3)
+            st.cpuSec = round(cpu - startCpu, 3)
+            st.startRssMb = round(startRss, 1) if startRss is not None else None
+            st.processPeakRssMb = round(peakRss, 1)
+            st.peakRssMb = round(peakRss, 1) if peakRss > startPeakRss else None
+            st.childPeakRssMb = round(childPeakRss, 1) if childPeakRss > startChildPeakRss else None
+            self.stages.append(st)
+            if st.peakRssMb is not None:
+                memory = u'peak memory %.0f MB' % st.peakRssMb
+            else:
+                memory = u'memory below the earlier peak of %.0f MB' % st.processPeakRssMb
+            safePrint(u'Stage %s%s: %.1fs, %.1fs CPU, %s%s' % (
+                name, u'' if st.ok else u' failed', st.wallSec, st.cpuSec, memory,
+                u', %d rows' % st.rows if st.rows is not None else u''))
+
+    def addStageRows(self, count):
+        """
+        Add to the number of rows processed by the innermost running stage, if any
+        """
+        if self._activeStages:
+            st = self._activeStages[-1]
+            st.rows = (st.rows or 0) + count
+
+    def saveRunHistory(self, startTs):
+        """
+        Append this run and its stages as one JSON line to the run history file
+        """
+        record = {
+            'ts': self.formatDate(startTs, self.dateTimeFormat),
+            'script': self.__class__.__name__,
+            'settings': self.settingsFile,
+            'ok': bool(self.stages) and self.stages[-1].ok,
+            'stages': self.stages,
+        }
+        with io.open(self.runHistoryFile, 'ab') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
     def safeRun(self):
+        startTs = datetime.now()
+        self.stages = []
         # noinspection PyBroadException
         try:
             self.saveSettings() # Ensure the file exists from the start
-            self.run()
+            with self.stage('run'):
+                self.profiledRun()
             self.settings.lastGoodRunTs = datetime.now()
         except:
             self.error(traceback.format_exc())
+        # noinspection PyBroadException
+        try:
+            self.saveRunHistory(startTs)
+        except:
+            safePrint(u'Unable to save run history\n' + traceback.format_exc())
         self.saveSettings()
 
+    def profiledRun(self):
+        """
+        Call run(), profiling it if requested by the profiler setting or the ZERO_PROFILE environment variable.
+        The .prof file (for pstats, snakeviz, ...) or the .collapsed stacks (for flamegraph.pl) go to profileDir.
+        """
+        mode = os.environ.get(profilerEnvVar, self.settings.profiler)
+        if not mode:
+            self.run()
+            return
+        if mode not in ('cprofile', 'sampling'):
+            raise ValueError('Unknown profiler "%s", expecting cprofile or sampling' % mode)
+
+        filename = os.path.join(self.profileDir, '%s-%s.%s' % (
+            self.__class__.__name__, datetime.now().strftime('%Y%m%d-%H%M%S'),
+            'prof' if mode == 'cprofile' else 'collapsed'))
+        if mode == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(self.run)
+            finally:
+                profiler.dump_stats(filename)
+                safePrint(u'Profile saved to %s' % filename)
+        else:
+            profiler = SamplingProfiler(self.settings.profilerInterval)
+            profiler.start()
+            try:
+                self.run()
+            finally:
+                profiler.stop()
+                profiler.save(filename)
+                safePrint(u'%d profile samples saved to %s' % (sum(profiler.stacks.values()), filename))
+
     def run(self):
         pass
 
@@ -223,6 +716,8 @@ class LogProcessor(ScriptProcessor):
 
         self.pathLogs = self.normalizePath(self.settings.pathLogs)
         self.pathCache = self.normalizePath(self.settings.pathCache)
+        self.runHistoryFile = os.path.join(self.pathCache, 'run-history.jsonl')
+        self.profileDir = self.pathCache
 
     def defaultSettings(self, suffix):
         s = super(LogProcessor, self).defaultSettings(suffix)
@@ -231,4 +726,14 @@ class LogProcessor(ScriptProcessor):
         suffix = os.sep + suffix if suffix else ''
         s.pathLogs = 'logs' + suffix
         s.pathCache = 'cache' + suffix
+        # Number of worker processes for the steps that can run in parallel, 0 to run everything serially
+        s.parallelProcesses = 0
+        # Seconds between the throughput lines, and the number of example lines kept per type of error
+        s.progressInterval = 30
+        s.errorSamples = 5
+        # Rows per chunk when loading the combined file for the graphs
+        s.readChunkRows = 1000000
         return s
+
+    def createDiagnostics(self, name=u'', totalBytes=0):
+        return Diagnostics(name, totalBytes, self.settings.progressInterval, self.settings.errorSamples)
@@ -1,9 +1,16 @@
+import array
+import gc
+import hashlib
 import io
 import json
-from operator import itemgetter
+import multiprocessing
 import os
+import random
+import shutil
+import struct
+import sys
 from datetime import *
-from collections import defaultdict
+from collections import defaultdict, MutableMapping
 from itertools import *
 
 # Daily totals -
@@ -82,6 +89,34 @@ multiactions = {u'smscontent', u'more-no-content', u'more-no-session'}
 
 entrySpecials = {'id', 'ts', 'partner'}
 
+epochOrdinal = date(1970, 1, 1).toordinal()
+
+
+def compileStateMachine(transitions, multiActions):
+    """
+    Convert the state machine into integer state ids and a dense transition table
+    :return: list of state names (the id is the index), transition table where
+             table[fromId * len(states) + toId] is 1 for the allowed transitions,
+             and a table of multi-action flags indexed by the state id
+    """
+    states = [u''] + sorted(set(s for t in transitions for s in t).union(multiActions, [u'err--bad-transitions'])
+                            - {u''})
+    ids = dict((s, i) for i, s in enumerate(states))
+    count = len(states)
+    table = bytearray(count * count)
+    for fromState, toState in transitions:
+        table[ids[fromState] * count + ids[toState]] = 1
+    multi = bytearray(count)
+    for s in multiActions:
+        multi[ids[s]] = 1
+    return states, table, multi
+
+
+knownStates, transitionTable, multiActionTable = compileStateMachine(okTransitions, multiactions)
+emptyStateId = knownStates.index(u'')
+startStateId = knownStates.index(u'start')
+badTransitionsStateId = knownStates.index(u'err--bad-transitions')
+
 
 class Entry(object):
     def __init__(self, userId, ts, partner):
@@ -165,10 +200,221 @@ class SumEntry(object):
             if self.max < value:
                 self.max = value
 
+    def addEntry(self, entry):
+        """
+        Merge another SumEntry into this one, same as calling addValue() for each of its values
+        :type entry: SumEntry
+        """
+        self.count += entry.count
+        if not entry.countOnly():
+            self.sum += entry.sum
+            if self.min > entry.min:
+                self.min = entry.min
+            if self.max < entry.max:
+                self.max = entry.max
+
     def countOnly(self):
         return 'sum' not in self.__dict__
 
 
+# Binary snapshot of Stats.stats: a header, the entry columns of each partner, and then the interned key tables
+# with the index of the partners, so that each partner can be decoded only when it is used
+snapshotSuffix = '.bin'
+snapshotMagic = 'ZSMSSTAT'
+snapshotVersion = 1
+# magic, version, offset of the key tables
+snapshotHeader = struct.Struct('<8sIQ')
+# Entry columns: stage key id, period key id, flags, count, sum, min, max
+snapshotColumns = ('I', 'I', 'B', 'd', 'd', 'd', 'd')
+# Flags of an entry: it has sum/min/max, and which of them are floats rather than ints
+flagHasSum, flagFloatSum, flagFloatMin, flagFloatMax = 1, 2, 4, 8
+
+
+def writeStrings(f, strings):
+    data = u'\x00'.join(strings).encode('utf-8')
+    f.write(struct.pack('<II', len(strings), len(data)))
+    f.write(data)
+
+
+def readStrings(f):
+    count, size = struct.unpack('<II', f.read(8))
+    return f.read(size).decode('utf-8').split(u'\x00') if count else []
+
+
+def saveSnapshot(filename, stats):
+    """
+    Save the stats as a binary snapshot that can be loaded with StatsSnapshot
+    :type stats: dict
+    """
+    stageIds, periodIds = {}, {}
+    stageNames, periodNames = [], []
+    partners = sorted(stats)
+    offsets, counts = [], []
+    tmpFile = filename + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        f.write(snapshotHeader.pack(snapshotMagic, snapshotVersion, 0))
+        for partner in partners:
+            cols = [array.array(code) for code in snapshotColumns]
+            stageCol, periodCol, flagsCol, countCol, sumCol, minCol, maxCol = cols
+            for stage, stat in stats[partner].iteritems():
+                stageId = stageIds.get(stage)
+                if stageId is None:
+                    stageId = stageIds[stage] = len(stageNames)
+                    stageNames.append(stage)
+                periods = stat.keys()
+                for period in periods:
+                    if period not in periodIds:
+                        periodIds[period] = len(periodNames)
+                        periodNames.append(period)
+                entries = [getattr(entry, '__dict__', entry) for entry in stat.values()]
+                stageCol.fromlist([stageId] * len(entries))
+                periodCol.fromlist([periodIds[period] for period in periods])
+                countCol.fromlist([vals['count'] for vals in entries])
+                if not any(['sum' in vals for vals in entries]):
+                    zeros = [0] * len(entries)
+                    for col in (flagsCol, sumCol, minCol, maxCol):
+                        col.fromlist(zeros)
+                    continue
+                flagsCol.fromlist([(flagHasSum |
+                                    (flagFloatSum if type(vals['sum']) is float else 0) |
+                                    (flagFloatMin if type(vals['min']) is float else 0) |
+                                    (flagFloatMax if type(vals['max']) is float else 0)) if 'sum' in vals else 0
+                                   for vals in entries])
+                sumCol.fromlist([vals.get('sum', 0) for vals in entries])
+                minCol.fromlist([vals.get('min', 0) for vals in entries])
+                maxCol.fromlist([vals.get('max', 0) for vals in entries])
+            offsets.append(f.tell())
+            counts.append(len(stageCol))
+            for col in cols:
+                if sys.byteorder != 'little':
+                    col.byteswap()
+                col.tofile(f)
+
+        tablesOffset = f.tell()
+        writeStrings(f, [unicode(p) for p in partners])
+        writeStrings(f, stageNames)
+        writeStrings(f, periodNames)
+        f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        f.write(struct.pack('<%dI' % len(counts), *counts))
+        f.seek(0)
+        f.write(snapshotHeader.pack(snapshotMagic, snapshotVersion, tablesOffset))
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpFile, filename)
+
+
+class StatsSnapshot(MutableMapping):
+    """
+    Stats dictionary backed by a binary snapshot file. A partner's stats are decoded the first time it is accessed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(snapshotHeader.size)
+            if len(header) != snapshotHeader.size:
+                raise ValueError('%s is not a version %d stats snapshot' % (filename, snapshotVersion))
+            magic, version, tablesOffset = snapshotHeader.unpack(header)
+            if magic != snapshotMagic or version != snapshotVersion:
+                raise ValueError('%s is not a version %d stats snapshot' % (filename, snapshotVersion))
+            f.seek(tablesOffset)
+            partners = readStrings(f)
+            self.stageNames = readStrings(f)
+            self.periodNames = readStrings(f)
+            offsets = struct.unpack('<%dQ' % len(partners), f.read(8 * len(partners)))
+            counts = struct.unpack('<%dI' % len(partners), f.read(4 * len(partners)))
+        # partner -> (offset, entry count), or None once it has been replaced
+        self.index = dict(izip(partners, izip(offsets, counts)))
+        self.loaded = {}
+
+    def _load(self, offset, count):
+        cols = []
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            for code in snapshotColumns:
+                col = array.array(code)
+                col.fromfile(f, count)
+                if sys.byteorder != 'little':
+                    col.byteswap()
+                cols.append(col)
+
+        stageNames, periodNames = self.stageNames, self.periodNames
+        newEntry = SumEntry.__new__
+        data = {}
+        stat = lastStageId = None
+        # The cyclic garbage collector would run many times while creating the entries, none of which can be freed
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            # Entries are written grouped by stage, so the stage dictionary only changes between the groups
+            for stageId, periodId, flags, count, sumVal, minVal, maxVal in izip(*cols):
+                if stageId != lastStageId:
+                    stat = data.setdefault(stageNames[stageId], {})
+                    lastStageId = stageId
+                entry = newEntry(SumEntry)
+                if flags:
+                    entry.__dict__ = {
+                        u'count': int(count),
+                        u'sum': sumVal if flags & flagFloatSum else int(sumVal),
+                        u'min': minVal if flags & flagFloatMin else int(minVal),
+                        u'max': maxVal if flags & flagFloatMax else int(maxVal),
+                    }
+                else:
+                    entry.__dict__ = {u'count': int(count)}
+                stat[periodNames[periodId]] = entry
+        finally:
+            if gcEnabled:
+                gc.enable()
+        return data
+
+    def __getitem__(self, partner):
+        try:
+            return self.loaded[partner]
+        except KeyError:
+            data = self._load(*self.index[partner])
+            self.loaded[partner] = data
+            return data
+
+    def __setitem__(self, partner, data):
+        self.loaded[partner] = data
+        self.index[partner] = None
+
+    def __delitem__(self, partner):
+        del self.index[partner]
+        self.loaded.pop(partner, None)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, partner):
+        return partner in self.index
+
+
+def selectKth(values, k):
+    """
+    Quickselect - find the k-th smallest value (0-based) in O(n) on average, without sorting the whole list
+    :type values: list
+    :type k: int
+    """
+    while True:
+        pivot = random.choice(values)
+        lower = [v for v in values if v < pivot]
+        if k < len(lower):
+            values = lower
+            continue
+        k -= len(lower)
+        equalCount = len(values) - len(lower)
+        higher = [v for v in values if v > pivot]
+        equalCount -= len(higher)
+        if k < equalCount:
+            return pivot
+        k -= equalCount
+        values = higher
+
+
 def splitKey(key):
     isError = key.startswith(u'err-')
     if isError:
@@ -188,6 +434,29 @@ def splitKey(key):
     return isError, key, tp
 
 
+def splitLine(line, cContent=6):
+    """
+    Split a combined log line into all of its columns, hiding the actual SMS content
+    """
+    parts = [v.strip() for v in line.split(u'\t')]
+    if len(parts) > cContent and parts[cContent].startswith(u'content='):
+        parts[cContent] = u'content=' + str(len(parts[cContent]) - 10) + u'chars'
+    return parts
+
+
+def formatSession(sessionLines, cAction=5):
+    """
+    Re-create the error report text of a session from its raw lines
+    :param sessionLines: list of (seconds from start, line), the first line has no seconds
+    """
+    parts = splitLine(sessionLines[0][1])
+    result = parts[1:]
+    for secondsFromStart, line in sessionLines[1:]:
+        result.append(str(secondsFromStart))
+        result.extend(splitLine(line)[cAction:])
+    return u'\n' + parts[0] + u'\n' + u'\t'.join(result) + u'\n'
+
+
 def filterData(data, isError=False, isNewUser=False, isUnique=False, knownState=True, includeStats=False,
                yieldTuple=False):
     for key, dates in data.items():
@@ -221,208 +490,516 @@ def filterData(data, isError=False, isNewUser=False, isUnique=False, knownState=
 
 
 def createStatesGraph(partnerDir, data, states):
-    d = sorted(filterData(data, yieldTuple=True),
-               key=lambda v:
-               v[0] + v[1])
-    # v[u'date'] + v[u'state'])
-    # groups = groupby(d, key=itemgetter(''))
-    #     [{'type':k, 'items':[x[0] for x in v]} for k, v in groups]
-    # from itertools import groupby, islice
-    # from operator import itemgetter
-    # from collections import defaultdict
-
-    # probably splitting this up in multiple lines would be more readable
-    pivot = (
-        (
-            ts,
-            defaultdict(lambda: '', (islice(d, 1, None) for d in dd))
-        )
-        for ts, dd in groupby(d, itemgetter(0)))
+    """
+    Write the count of each state per day, one line for each day that has any known state
+    """
+    # date -> {state: count}, so that only the distinct dates have to be sorted
+    byDate = defaultdict(dict)
+    for ts, state, count in filterData(data, yieldTuple=True):
+        byDate[ts][state] = count
+
+    lines = [u'date\t' + u'\t'.join(states) + u'\n']
+    for ts in sorted(byDate):
+        counts = byDate[ts]
+        lines.append(ts + u'\t' + u'\t'.join([str(counts[s]) if s in counts else u'' for s in states]) + u'\n')
 
     resultFile = os.path.join(partnerDir, 'states-count-per-day.tsv')
     with io.open(resultFile, 'w', encoding='utf8') as f:
-        f.write(u'date\t' + u'\t'.join(states) + u'\n')
-        for ts, counts in pivot:
-            f.write(ts + u'\t' + u'\t'.join(str(counts[s]) for s in states) + u'\n')
+        f.write(u''.join(lines))
+
+
+# The stats of all partners while createGraphs() runs in parallel. The forked workers inherit them,
+# which is much faster than pickling each partner's stats to them
+graphStats = None
+
+
+def createStatesGraphWorker(args):
+    """
+    Multiprocessing worker - write the graph of one partner
+    """
+    partner, partnerDir, states = args
+    createStatesGraph(partnerDir, graphStats[partner], states)
+
+
+class FileRange(io.RawIOBase):
+    """
+    Read-only raw stream over the [start, end) byte range of a file
+    """
+
+    def __init__(self, filename, start, end):
+        super(FileRange, self).__init__()
+        self.file = io.open(filename, 'rb', buffering=0)
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self.remaining)
+        if size <= 0:
+            return 0
+        size = self.file.readinto(memoryview(b)[:size])
+        self.remaining -= size
+        return size
+
+    def close(self):
+        self.file.close()
+        super(FileRange, self).close()
+
+
+def findShardOffsets(filename, count):
+    """
+    Split a sorted combined log into up to count byte ranges, so that lines of the same user
+    (and thus all of the user's sessions) are never split between two ranges
+    :return: list of offsets, the first one is 0, the last one is the file size
+    """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with io.open(filename, 'rb') as f:
+        for i in range(1, count):
+            pos = size * i // count
+            if pos <= offsets[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()  # skip to the beginning of the next line
+            userId = None
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                lineUserId = line.split(b'\t', 1)[0].strip()
+                if userId is not None and userId != lineUserId:
+                    break
+                userId = lineUserId
+            if pos >= size:
+                break
+            offsets.append(pos)
+    offsets.append(size)
+    return offsets
+
+
+def processShard(args):
+    """
+    Multiprocessing worker - process one range of the combined log
+    """
+    sourceFile, errFile, start, end, isLastShard, partnerMap = args
+    stats = Stats(sourceFile, None, None, dict(partnerMap))
+    with io.open(errFile, 'w', encoding='utf8') as fErr, \
+            io.TextIOWrapper(io.BufferedReader(FileRange(sourceFile, start, end)), encoding='utf8') as lines:
+        stats._processLines(lines, fErr, isLastShard)
+    return stats._getCounters()
 
 
 class Stats(object):
     def __init__(self, sourceFile, graphDir, stateFile, partnerMap=None, partnerDirMap=None, salt=''):
-        self.newUserUnique = set()
-        self.unique = defaultdict(dict)
         self.sourceFile = sourceFile
         self.graphDir = graphDir
         self.stateFile = stateFile
+        self.snapshotFile = stateFile + snapshotSuffix if stateFile else None
         self.partnerMap = partnerMap if partnerMap is not None else {}
         self.partnerDirMap = partnerDirMap if partnerDirMap is not None else {}
         self.salt = salt
         self.stats = {}
 
-    def _addStats(self, partner, stage, key2, value=-1):
-        p = partner if partner is not None else 'allpartners'
+        # While processing, all stats are keyed by integer ids. Partner and stage names,
+        # as well as the date strings, are only materialized by _cleanupStats()
+        self._partnerIds = {}
+        self._partnerNames = []
+        self._partnerKeyIds = {}
+        self._stageIds = dict((s, i) for i, s in enumerate(knownStates))
+        self._stageNames = list(knownStates)
+        self._errorStages = {}
+        self._variantStages = {}
+        # (partnerId, stageId, day) -> SumEntry
+        self._totals = {}
+        # (stageId, day, userId) -> partnerId that has seen it first
+        self._uniques = {}
+        # userId -> (partnerId, day) when the user was first seen
+        self._newUsers = {}
+        # (partnerId, stageId, month) -> {userId: count}
+        self._userMonths = {}
+
+        self._days = {}
+        self._dailyKeys = {}
+        self._months = {}
+
+    def _getPartnerId(self, partner):
         try:
-            partnerStat = self.stats[p]
+            return self._partnerIds[partner]
+        except KeyError:
+            partnerId = len(self._partnerNames)
+            self._partnerIds[partner] = partnerId
+            self._partnerNames.append(partner)
+            return partnerId
+
+    def _getStageId(self, stage):
+        try:
+            return self._stageIds[stage]
+        except KeyError:
+            stageId = len(self._stageNames)
+            self._stageIds[stage] = stageId
+            self._stageNames.append(stage)
+            return stageId
+
+    def _getErrorStageId(self, isError, fromId, toId):
+        key = (isError, fromId, toId)
+        try:
+            return self._errorStages[key]
+        except KeyError:
+            stage = (u'err-cont-' if isError else u'err-new-') + \
+                self._stageNames[fromId] + u'-' + self._stageNames[toId]
+            stageId = self._getStageId(stage)
+            self._errorStages[key] = stageId
+            return stageId
+
+    def _getVariantStageIds(self, stageId):
+        """
+        :return: stage ids of the first, second, and third+ occurrence of the multi-action
+        """
+        try:
+            return self._variantStages[stageId]
+        except KeyError:
+            stage = self._stageNames[stageId]
+            ids = (stageId, self._getStageId(stage + u'-2'), self._getStageId(stage + u'-3+'))
+            self._variantStages[stageId] = ids
+            return ids
+
+    def _setStat(self, partner, stage, key2, entry):
+        try:
+            partnerStat = self.stats[partner]
         except KeyError:
             partnerStat = dict()
-            self.stats[p] = partnerStat
+            self.stats[partner] = partnerStat
         try:
             stat = partnerStat[stage]
         except KeyError:
             stat = dict()
             partnerStat[stage] = stat
         if key2 not in stat:
-            stat[key2] = SumEntry(value)
+            stat[key2] = entry
         else:
-            stat[key2].addValue(value)
-        # two-stage addition - one for partner, one total
-        if partner is not None:
-            self._addStats(None, stage, key2, value)
+            stat[key2].addEntry(entry)
 
     def _cleanupStats(self):
-        del self.unique
-        del self.newUserUnique
-        for partner, partnerData in self.stats.items():
-            if partner == 'allpartners':
-                continue
-            for k in list([i for i in partnerData if u'_usrmonth_' in i]):
-                kk = k.split(u'_', 2)
-                # removing top 1% of the heavy users
-                vals = list(sorted(partnerData[k].values(), key=lambda l: l.count))
-                vals = vals[0:len(vals) - int(len(vals) * 0.01)]
-                for v in vals:
-                    self._addStats(partner, kk[0] + u'_' + kk[1], kk[1] + u'_' + kk[2], v.count)
-                del partnerData[k]
-                if k in self.stats['allpartners']:
-                    del self.stats['allpartners'][k]
-
-    def _addStatsUniqueUser(self, partner, key2, userId):
-        if userId not in self.newUserUnique:
-            self.newUserUnique.add(userId)
-            self._addStats(partner, u'newuser', key2)
-
-    def _addStatsUnique(self, partner, stage, key2, userId):
-        u = self.unique[stage]
-        if key2 not in u:
-            u[key2] = {userId}
-        elif userId not in u[key2]:
-            u[key2].add(userId)
+        """
+        Remove the top 1% of the heavy users, and convert integer-keyed counters into the stats dictionary
+        """
+        partners = self._partnerNames
+        stages = self._stageNames
+        self.stats = {}
+
+        for (partnerId, stageId, day), entry in self._totals.iteritems():
+            self._setStat(partners[partnerId], stages[stageId], self._getDailyKey(day), entry)
+
+        counts = defaultdict(int)
+        for (stageId, day, userId), partnerId in self._uniques.iteritems():
+            counts[(partnerId, stageId, day)] += 1
+        for (partnerId, stageId, day), count in counts.iteritems():
+            self._setStat(partners[partnerId], stages[stageId] + u'_unique', self._getDailyKey(day),
+                          SumEntry({u'count': count}))
+
+        counts = defaultdict(int)
+        for partnerId, day in self._newUsers.itervalues():
+            counts[(partnerId, day)] += 1
+        for (partnerId, day), count in counts.iteritems():
+            self._setStat(partners[partnerId], u'newuser', self._getDailyKey(day), SumEntry({u'count': count}))
+
+        for (partnerId, stageId, month), users in self._userMonths.iteritems():
+            k = u'%s_usrmonth_%02d-%d' % (stages[stageId], month % 12 + 1, month // 12)
+            kk = k.split(u'_', 2)
+            # removing top 1% of the heavy users
+            counts = users.values()
+            dropCount = int(len(counts) * 0.01)
+            if dropCount > 0:
+                keepCount = len(counts) - dropCount
+                # the largest count we keep - everything below it stays, plus as many of its duplicates as fit
+                threshold = selectKth(counts, keepCount - 1)
+                counts = [c for c in counts if c < threshold]
+                counts.extend([threshold] * (keepCount - len(counts)))
+            if counts:
+                entry = SumEntry({u'count': len(counts), u'sum': sum(counts), u'min': min(counts),
+                                  u'max': max(counts)})
+                self._setStat(partners[partnerId], kk[0] + u'_' + kk[1], kk[1] + u'_' + kk[2], entry)
+
+        del self._totals, self._uniques, self._newUsers, self._userMonths
+
+        # roll up all partners into one total
+        allStats = {}
+        for partnerData in self.stats.itervalues():
+            for stage, stat in partnerData.iteritems():
+                try:
+                    allStat = allStats[stage]
+                except KeyError:
+                    allStat = dict()
+                    allStats[stage] = allStat
+                for key2, entry in stat.iteritems():
+                    if key2 not in allStat:
+                        allStat[key2] = SumEntry(dict(entry.__dict__))
+                    else:
+                        allStat[key2].addEntry(entry)
+        self.stats['allpartners'] = allStats
+
+    def parseTimestamp(self, value):
+        """
+        Convert "YYYY-MM-DD HH:MM:SS" into seconds since epoch. Only the date part is parsed with strptime,
+        once per day, the time is taken from the fixed offsets
+        :type value: unicode
+        :rtype: int
+        """
+        if len(value) != 19:
+            raise ValueError(u'Invalid timestamp "%s"' % value)
+        try:
+            day = self._days[value[:10]]
+        except KeyError:
+            day = datetime.strptime(value[:10], u'%Y-%m-%d').toordinal() - epochOrdinal
+            self._days[value[:10]] = day
+        return day * 86400 + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+
+    def _getDailyKey(self, day):
+        try:
+            return self._dailyKeys[day]
+        except KeyError:
+            key = u'daily_' + date.fromordinal(day + epochOrdinal).strftime(u'%Y-%m-%d')
+            self._dailyKeys[day] = key
+            return key
+
+    def _getMonth(self, day):
+        """
+        :return: month ordinal (year * 12 + month - 1) of the day
+        """
+        try:
+            return self._months[day]
+        except KeyError:
+            dt = date.fromordinal(day + epochOrdinal)
+            month = dt.year * 12 + dt.month - 1
+            self._months[day] = month
+            return month
+
+    def addStats(self, partnerId, stageId, day, month, userId, value=-1):
+        key = (partnerId, stageId, day)
+        entry = self._totals.get(key)
+        if entry is None:
+            self._totals[key] = SumEntry(value)
         else:
-            return
-        self._addStats(partner, stage, key2)
-    #        if not isError:
-    #            key2 = u'hourly_' + ts.strftime(u'%Y-%m-%d %H') + u':00'
-    #            self._addStats(partner, key, key2, value)
-
-    def addStats(self, partner, stage, ts, userId, value=-1):
-        #        self._addStats(partner, key, u'_totals', value)
-        #        self._addStatsUnique(partner, stage + u'_unique', u'_totals', id)
-
-        key2 = u'daily_' + ts.strftime(u'%Y-%m-%d')
-        self._addStats(partner, stage, key2, value)
-        self._addStatsUnique(partner, stage + u'_unique', key2, userId)
-
-        self._addStats(partner, stage + u'_usrmonth_' + ts.strftime(u'%m-%Y'), userId)
-
-    def countStats(self, entry):
-        ts = entry.ts
-        userId = entry.id
-        self.addStats(entry.partner, u'start', ts, userId)
-        self._addStatsUniqueUser(entry.partner, u'daily_' + ts.strftime(u'%Y-%m-%d'), userId)
-        for k, v in entry.entryItems():
+            entry.addValue(value)
+
+        key = (stageId, day, userId)
+        if key not in self._uniques:
+            self._uniques[key] = partnerId
+
+        key = (partnerId, stageId, month)
+        users = self._userMonths.get(key)
+        if users is None:
+            self._userMonths[key] = {userId: 1}
+        else:
+            users[userId] = users.get(userId, 0) + 1
+
+    def countStats(self, partnerId, ts, userId, actions):
+        """
+        :type actions: dict
+        :param actions: stageId -> seconds from start, or a list of them for multi-actions
+        """
+        day = ts // 86400
+        month = self._getMonth(day)
+        self.addStats(partnerId, startStateId, day, month, userId)
+        if userId not in self._newUsers:
+            self._newUsers[userId] = (partnerId, day)
+        for stageId, v in actions.iteritems():
             if type(v) is list:
-                maxN = 2
-                for i in range(min(len(v), maxN + 1)):
-                    self.addStats(entry.partner,
-                                  k + (u'' if i == 0 else '-' + str(i + 1) + ('+' if i == maxN else '')),
-                                  ts, userId, v[i])
+                stageIds = self._getVariantStageIds(stageId)
+                for i in range(min(len(v), len(stageIds))):
+                    self.addStats(partnerId, stageIds[i], day, month, userId, v[i])
             else:
-                self.addStats(entry.partner, k, ts, userId, v)
+                self.addStats(partnerId, stageId, day, month, userId, v)
 
-    def process(self):
+    def process(self, processes=0):
+        """
+        Parse the combined log file
+        :param processes: if more than one, split the file into that many shards, and process them in parallel
+        """
+        errFile = os.path.join(self.graphDir, 'errors.txt')
+        if processes > 1:
+            self._processParallel(errFile, processes)
+        else:
+            with io.open(errFile, 'w', encoding='utf8') as fErr, \
+                    io.open(self.sourceFile, encoding='utf8') as lines:
+                self._processLines(lines, fErr, True)
 
+        self._cleanupStats()
+
+    def _processParallel(self, errFile, processes):
+        offsets = findShardOffsets(self.sourceFile, processes)
+        partnerMap = dict(self.partnerMap)
+        shards = [(self.sourceFile, errFile + '.%d' % i, offsets[i], offsets[i + 1], i == len(offsets) - 2,
+                   partnerMap)
+                  for i in range(len(offsets) - 1)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            # Shards must be merged in the file order for the unique counts to match the serial processing
+            with io.open(errFile, 'wb') as fErr:
+                for shard, counters in izip(shards, pool.imap(processShard, shards)):
+                    self._mergeCounters(counters)
+                    with io.open(shard[1], 'rb') as f:
+                        shutil.copyfileobj(f, fErr)
+                    os.remove(shard[1])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _getCounters(self):
+        return (self._partnerNames, self._stageNames, self._totals, self._uniques, self._newUsers,
+                self._userMonths, self.partnerMap)
+
+    def _mergeCounters(self, counters):
+        """
+        Add counters of another Stats object, processed on the lines that follow this object's lines
+        """
+        partnerNames, stageNames, totals, uniques, newUsers, userMonths, partnerMap = counters
+        partnerIds = [self._getPartnerId(v) for v in partnerNames]
+        stageIds = [self._getStageId(v) for v in stageNames]
+
+        for (partnerId, stageId, day), entry in totals.iteritems():
+            key = (partnerIds[partnerId], stageIds[stageId], day)
+            if key not in self._totals:
+                self._totals[key] = entry
+            else:
+                self._totals[key].addEntry(entry)
+        for (stageId, day, userId), partnerId in uniques.iteritems():
+            key = (stageIds[stageId], day, userId)
+            if key not in self._uniques:
+                self._uniques[key] = partnerIds[partnerId]
+        for userId, (partnerId, day) in newUsers.iteritems():
+            if userId not in self._newUsers:
+                self._newUsers[userId] = (partnerIds[partnerId], day)
+        for (partnerId, stageId, month), users in userMonths.iteritems():
+            key = (partnerIds[partnerId], stageIds[stageId], month)
+            existing = self._userMonths.get(key)
+            if existing is None:
+                self._userMonths[key] = users
+            else:
+                for userId, count in users.iteritems():
+                    existing[userId] = existing.get(userId, 0) + count
+        self.partnerMap.update(partnerMap)
+
+    def _processLines(self, lines, fErr, isLastShard):
+        """
+        :param isLastShard: False if more lines follow these, so the last session is complete and must be counted
+        """
         cId = 0
         cTime = 1
         cPartner = 4
         cAction = 5
-        cContent = 6
 
-        fErr = io.open(os.path.join(self.graphDir, 'errors.txt'), 'w', encoding='utf8')
+        stateCount = len(knownStates)
+        stageIds = self._stageIds
 
         isError = False
-        lastAction = u''
+        lastActionId = emptyStateId
         lastLine = u''
-        lastParts = False
-        entry = None
-        for line in io.open(self.sourceFile, encoding='utf8'):
+        # Raw lines of the current session, only formatted if the session has an error
+        sessionLines = False
+        entryId = entryTs = partnerId = actions = None
+        for line in lines:
             if line == u'':
                 break
             if line == lastLine:
                 continue
             lastLine = line
 
-            parts = [v.strip() for v in line.split(u'\t')]
-            if len(parts) > cContent and parts[cContent].startswith(u'content='):
-                parts[cContent] = u'content=' + str(len(parts[cContent]) - 10) + u'chars'
-
-            action = parts[cAction]
-            timestamp = datetime.strptime(parts[cTime], u'%Y-%m-%d %H:%M:%S')
-            isNew = entry is None or entry.id != parts[cId] or action == u'start'
+            # Only split the columns we need, the rest of the line is only used in error reports
+            parts = line.split(u'\t', cAction + 1)
+            userId = parts[cId].strip()
+            action = parts[cAction].strip()
+            try:
+                actionId = stageIds[action]
+            except KeyError:
+                actionId = self._getStageId(action)
+            timestamp = self.parseTimestamp(parts[cTime].strip())
+            isNew = entryId is None or entryId != userId or actionId == startStateId
 
             if isNew:
-                if entry is not None:
-                    self.countStats(entry)
-                partnerKey = u'|'.join(parts[cPartner - 2:cPartner + 1])
-                if partnerKey in self.partnerMap:
-                    partner = self.partnerMap[partnerKey]
-                else:
-                    if parts[cPartner] == u'':
-                        partner = u'-'.join(parts[cPartner - 2:cPartner])
+                if entryId is not None:
+                    self.countStats(partnerId, entryTs, entryId, actions)
+                partnerKey = u'|'.join([v.strip() for v in parts[cPartner - 2:cPartner + 1]])
+                try:
+                    partnerId = self._partnerKeyIds[partnerKey]
+                except KeyError:
+                    if partnerKey in self.partnerMap:
+                        partner = self.partnerMap[partnerKey]
                     else:
-                        partner = parts[cPartner]
-                    self.partnerMap[partnerKey] = partner
-                entry = Entry(parts[cId], timestamp, partner)
-                lastParts = parts
-                lastAction = u''
+                        partnerParts = partnerKey.split(u'|')
+                        if partnerParts[2] == u'':
+                            partner = u'-'.join(partnerParts[0:2])
+                        else:
+                            partner = partnerParts[2]
+                        self.partnerMap[partnerKey] = partner
+                    partnerId = self._getPartnerId(partner)
+                    self._partnerKeyIds[partnerKey] = partnerId
+                entryId = userId
+                entryTs = timestamp
+                actions = {}
+                sessionLines = [(None, line)]
+                lastActionId = emptyStateId
                 isError = False
 
-            transition = (lastAction, action)
-            secondsFromStart = int((timestamp - entry.ts).total_seconds())
-            isMultiAction = action in multiactions
-            isNewAction = action not in entry
-
-            if isError or transition not in okTransitions or (not isNewAction and not isMultiAction):
-                if lastParts:
-                    fErr.write(u'\n' + lastParts[0] + u'\n' + (u'\t'.join(lastParts[1:])) + u'\n')
-                parts[cPartner] = str(secondsFromStart)
-                del parts[cId]
-                fErr.write(u'\t'.join(parts) + u'\n')
-                self.addStats(entry.partner, u'err--bad-transitions', timestamp, entry.id, secondsFromStart)
-                key = (u'err-cont-' if isError else u'err-new-') + transition[0] + u'-' + transition[1]
-                self.addStats(entry.partner, key, timestamp, entry.id, secondsFromStart)
-                lastParts = False
+            secondsFromStart = timestamp - entryTs
+            isKnown = actionId < stateCount
+            isMultiAction = isKnown and multiActionTable[actionId]
+            isNewAction = actionId not in actions
+
+            if isError or not (isKnown and lastActionId < stateCount and
+                               transitionTable[lastActionId * stateCount + actionId]) or \
+                    (not isNewAction and not isMultiAction):
+                if sessionLines:
+                    fErr.write(formatSession(sessionLines, cAction))
+                errParts = splitLine(line)
+                errParts[cPartner] = str(secondsFromStart)
+                del errParts[cId]
+                fErr.write(u'\t'.join(errParts) + u'\n')
+                day = timestamp // 86400
+                month = self._getMonth(day)
+                self.addStats(partnerId, badTransitionsStateId, day, month, entryId, secondsFromStart)
+                self.addStats(partnerId, self._getErrorStageId(isError, lastActionId, actionId), day, month,
+                              entryId, secondsFromStart)
+                sessionLines = False
                 isError = True
             elif not isNew:
-                # noinspection PyTypeChecker
-                lastParts = lastParts + [str(secondsFromStart)] + parts[cAction:]
+                sessionLines.append((secondsFromStart, line))
                 if isNewAction:
-                    entry[action] = [secondsFromStart] if isMultiAction else secondsFromStart
+                    actions[actionId] = [secondsFromStart] if isMultiAction else secondsFromStart
                 else:
-                    entry[action].append(secondsFromStart)
+                    actions[actionId].append(secondsFromStart)
 
-            lastAction = action
+            lastActionId = actionId
 
-        if lastParts:
-            self.countStats(entry)
+        if sessionLines or (not isLastShard and entryId is not None):
+            self.countStats(partnerId, entryTs, entryId, actions)
 
-        self._cleanupStats()
-
-    def pickle(self):
-        with open(self.stateFile, 'wb') as f:
-            self.recursiveConvert(self.stats)
-            json.dump(self.stats, f, indent=True, sort_keys=True)
-            self.recursiveConvert(self.stats)
+    def pickle(self, exportJson=True):
+        """
+        Save the stats as a binary snapshot, and optionally also export them as JSON
+        """
+        if exportJson:
+            with open(self.stateFile, 'wb') as f:
+                json.dump(dict(self.stats), f, indent=True, sort_keys=True,
+                          default=lambda v: v.__dict__ if isinstance(v, SumEntry) else dict(v))
+        # Written after the JSON, so that unpickle() only prefers the JSON if it was changed afterwards
+        saveSnapshot(self.snapshotFile, self.stats)
 
     def unpickle(self):
+        if os.path.isfile(self.snapshotFile) and not (
+                os.path.isfile(self.stateFile) and
+                os.path.getmtime(self.stateFile) > os.path.getmtime(self.snapshotFile)):
+            try:
+                self.stats = StatsSnapshot(self.snapshotFile)
+                return
+            except ValueError:
+                # A snapshot of another format version, it is replaced by the next pickle()
+                if not os.path.isfile(self.stateFile):
+                    raise
         with io.open(self.stateFile, 'rb') as f:
             self.stats = json.load(f)
         self.recursiveConvert(self.stats)
@@ -500,62 +1077,92 @@ class Stats(object):
                     f.write(l + u'\n')
 
     def makePartnerDir(self, partner):
-        partnerKey = self.partnerDirMap[partner]
+        return self.makePartnerDirs([partner])[partner]
 
+    def makePartnerDirs(self, partners):
+        """
+        Create the data directories and the dashboards of the partners, listing the existing ones only once
+        :return: {partner: data directory}
+        """
         dashboard = os.path.join(self.graphDir, 'dashboards')
         if not os.path.exists(dashboard):
             os.mkdir(dashboard)
         datafiles = os.path.join(self.graphDir, 'datafiles')
         if not os.path.exists(datafiles):
             os.mkdir(datafiles)
-        dataDir = os.path.join(datafiles, partnerKey)
-        if not os.path.exists(dataDir):
-            os.mkdir(dataDir)
-
-        # Create an empty file with the partner's name to easily see who is who
-        # From http://stackoverflow.com/questions/295135/turn-a-string-into-a-valid-filename-in-python
-        sanitizedPartner = unicodedata.normalize('NFKD', unicode(partner)).encode('ascii', 'ignore')
-        sanitizedPartner = unicode(re.sub('[^\w\s-]', '', sanitizedPartner).strip().lower())
-        sanitizedPartner = re.sub('[-\s]+', '-', sanitizedPartner)
-        infoFile = os.path.join(dataDir, sanitizedPartner)
-        if not os.path.exists(infoFile):
-            open(infoFile, 'a').close()
-
-        # Create dashboard
-        dashboardFile = os.path.join(dashboard, partnerKey + '.json')
-        if not os.path.exists(dashboardFile):
-            data = {
-                "id": partnerKey,
-                "headline": partner,
-                # "subhead": "subtitle",
-                "tabs": [
-                    {
-                        "name": "Graphs",
-                        "graph_ids": [
-                            "http://gp.wmflabs.org/data/datafiles/gp_zero_local/%s/states-count-per-day.tsv"
-                            % partnerKey
-                        ]
-                    }
-                ]
-            }
-            with open(dashboardFile, 'wb') as f:
-                json.dump(data, f, indent=True, sort_keys=True)
+        existingDirs = set(os.listdir(datafiles))
+        existingDashboards = set(os.listdir(dashboard))
 
-        return dataDir
+        dataDirs = {}
+        for partner in partners:
+            if partner not in self.partnerDirMap:
+                self.partnerDirMap[partner] = hashlib.sha224((partner + self.salt).encode('utf-8')).hexdigest()
+            partnerKey = self.partnerDirMap[partner]
+
+            dataDir = os.path.join(datafiles, partnerKey)
+            isNewDir = partnerKey not in existingDirs
+            if isNewDir:
+                os.mkdir(dataDir)
+                existingDirs.add(partnerKey)
+            dataDirs[partner] = dataDir
+
+            # Create an empty file with the partner's name to easily see who is who
+            # From http://stackoverflow.com/questions/295135/turn-a-string-into-a-valid-filename-in-python
+            sanitizedPartner = unicodedata.normalize('NFKD', unicode(partner)).encode('ascii', 'ignore')
+            sanitizedPartner = unicode(re.sub('[^\w\s-]', '', sanitizedPartner).strip().lower())
+            sanitizedPartner = re.sub('[-\s]+', '-', sanitizedPartner)
+            infoFile = os.path.join(dataDir, sanitizedPartner)
+            if isNewDir or not os.path.exists(infoFile):
+                open(infoFile, 'a').close()
+
+            # Create dashboard
+            dashboardName = partnerKey + '.json'
+            if dashboardName not in existingDashboards:
+                data = {
+                    "id": partnerKey,
+                    "headline": partner,
+                    # "subhead": "subtitle",
+                    "tabs": [
+                        {
+                            "name": "Graphs",
+                            "graph_ids": [
+                                "http://gp.wmflabs.org/data/datafiles/gp_zero_local/%s/states-count-per-day.tsv"
+                                % partnerKey
+                            ]
+                        }
+                    ]
+                }
+                with open(os.path.join(dashboard, dashboardName), 'wb') as f:
+                    json.dump(data, f, indent=True, sort_keys=True)
+                existingDashboards.add(dashboardName)
 
-    def createGraphs(self):
+        return dataDirs
 
+    def createGraphs(self, processes=0):
+        """
+        :param processes: if more than one, write the partner graphs in that many worker processes
+        """
         states = sorted([stateNames[v] for v in goodStates])
 
-        for partner, data in self.stats.items():
-            if partner not in self.partnerDirMap:
-                import hashlib
-
-                partnerKey = hashlib.sha224(partner + self.salt).hexdigest()
-                self.partnerDirMap[partner] = partnerKey
-
-            partnerDir = self.makePartnerDir(partner)
-            createStatesGraph(partnerDir, data, states)
+        global graphStats
+
+        dataDirs = self.makePartnerDirs(self.stats.keys())
+        # Workers can only inherit the stats if they are forked
+        if processes > 1 and len(self.stats) > 1 and hasattr(os, 'fork'):
+            graphStats = self.stats
+            pool = multiprocessing.Pool(processes)
+            try:
+                tasks = [(partner, dataDirs[partner], states) for partner in self.stats]
+                for _ in pool.imap_unordered(createStatesGraphWorker, tasks, chunksize=16):
+                    pass
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+                graphStats = None
+        else:
+            for partner, data in self.stats.items():
+                createStatesGraph(dataDirs[partner], data, states)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,15 @@
 # coding=utf-8
+import codecs
+import gzip
+import hashlib
 import pipes
+import shutil
 import string
 import subprocess
 import locale
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
 from datetime import timedelta
 import re
 
@@ -21,11 +28,15 @@ def generatePassword(size=10, chars=string.ascii_letters + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
 
 
+# Everything that should be removed from the timestamp column
+timestampNoiseRe = re.compile(r' \[VumiRedis,client\]| \[HTTP11ClientProtocol,client\]| WIKI|\+0000')
+
+
 def writeLine(dst, line):
     if not line:
         return
     line = line.replace(u'\0', u'\\0')
-    parts = line.split('\t')
+    parts = line.split(u'\t')
     if parts[1][0] == u'+':
         return
     parts = [p[2:-1]
@@ -33,21 +44,161 @@ def writeLine(dst, line):
              else p for p in parts]
     tmp = parts[0]
     parts[0] = parts[1]
-    parts[1] = tmp \
-        .replace(u' [VumiRedis,client]', u'') \
-        .replace(u' [HTTP11ClientProtocol,client]', u'') \
-        .replace(u' WIKI', u'') \
-        .replace(u'+0000', u'')
+    parts[1] = timestampNoiseRe.sub(u'', tmp)
 
     if len(parts) > 5 and parts[5].startswith(u'content='):
         parts[5] = u'content=' + str(len(parts[5]) - 10)
 
-    if len(parts) > 6:
-        parts[6] = parts[6].replace(u'\0', u'\\0')
-
     dst.write(u'\t'.join(parts) + u'\n')
 
 
+manualLogRe = re.compile(r'^wikipedia_application_\d+\.log\.\d+\.gz:')
+
+
+class RecordJoiner(object):
+    """
+    Joins multi-line log records into single lines, and writes them to dst with writeLine()
+    """
+
+    def __init__(self, dst):
+        self.dst = dst
+        # Lines of the current record, joined only once the record is complete
+        self.fragments = None
+        self.count = 0
+
+    def feed(self, line):
+        self.feedLines((line,))
+
+    def feedLines(self, lines):
+        """
+        :type lines: list[unicode]
+        """
+        dst = self.dst
+        fragments = self.fragments
+        self.count += len(lines)
+        for l in lines:
+            l = l.strip(u'\n\r')
+            if l.startswith(u'wikipedia_application_'):
+                l = manualLogRe.sub(u'', l, 1)
+            if u' WIKI\t' in l:
+                if fragments is not None:
+                    writeLine(dst, u'\t'.join(fragments))
+                fragments = [l]
+            elif len(l) > 2 and l[0] == u'2' and l[1] == u'0':
+                if fragments is not None:
+                    writeLine(dst, u'\t'.join(fragments))
+                fragments = None
+            elif fragments is not None:
+                fragments.append(l)
+        self.fragments = fragments
+
+    def close(self):
+        if self.fragments is not None:
+            writeLine(self.dst, u'\t'.join(self.fragments))
+        self.fragments = None
+
+
+class StreamingLogWriter(object):
+    """
+    File-like object for boto's get_contents_to_file(). Saves the raw data to a file,
+    and at the same time decompresses and decodes it, and feeds its lines to the record joiner
+    """
+
+    def __init__(self, rawFile, joiner, isGzip):
+        self.rawFile = rawFile
+        self.joiner = joiner
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if isGzip else None
+        # Same decoding and newline handling as io.open(filename, 'r', encoding='utf8')
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf8')(), True)
+        self.pending = u''
+
+    def write(self, data):
+        self.rawFile.write(data)
+        self.parse(data)
+
+    def flush(self):
+        self.rawFile.flush()
+
+    def parse(self, data, final=False):
+        """
+        Process the data without saving it
+        """
+        if self.decompressor:
+            data = self.decompress(data, final)
+        lines = (self.pending + self.decoder.decode(data, final)).split(u'\n')
+        self.pending = lines.pop()
+        self.joiner.feedLines(lines)
+        if final and self.pending:
+            self.joiner.feed(self.pending)
+            self.pending = u''
+
+    def close(self):
+        self.parse(b'', True)
+        self.joiner.close()
+
+    def decompress(self, data, final):
+        """
+        Same as gzip.GzipFile, read all the concatenated gzip members, skipping the zero padding between them
+        """
+        results = []
+        while True:
+            results.append(self.decompressor.decompress(data))
+            # Once a member ends, the decompressor keeps all the following data as unused
+            data = self.decompressor.unused_data.lstrip(b'\x00')
+            if not data:
+                break
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if final:
+            results.append(self.decompressor.flush())
+        return b''.join(results)
+
+
+fingerprintBlockSize = 64 * 1024
+
+
+def hashFileRange(filePath, start, end):
+    start = max(0, start)
+    with io.open(filePath, 'rb') as f:
+        f.seek(start)
+        return hashlib.md5(f.read(max(0, end - start))).hexdigest()
+
+
+def isRecordBoundary(line):
+    """
+    Same as RecordJoiner - does this (bytes) line start a new record or end the previous one
+    """
+    l = line.strip(b'\n\r')
+    if l.startswith(b'wikipedia_application_'):
+        l = manualLogRe.sub(b'', l, 1)
+    return b' WIKI\t' in l or (len(l) > 2 and l[0:2] == b'20')
+
+
+def findLastRecordStart(f, end):
+    """
+    Scan the file backwards from the end, and find where the last record begins
+    :return: offset of the last line that starts or ends a record, or 0 if there are none
+    """
+    pos = end
+    tail = b''
+    while pos > 0:
+        start = max(0, pos - fingerprintBlockSize)
+        f.seek(start)
+        tail = f.read(pos - start) + tail
+        pos = start
+        lines = tail.split(b'\n')
+        offsets = []
+        offset = pos
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line) + 1
+        # Unless we reached the beginning of the file, the first line may be incomplete
+        for i in range(len(lines) - 1, 0 if pos > 0 else -1, -1):
+            if isRecordBoundary(lines[i]):
+                return offsets[i]
+        tail = lines[0]
+    return 0
+
+
 class SmsLogProcessor(LogProcessor):
 
     def __init__(self, settingsFile='settings/smslogs.json'):
@@ -55,6 +206,14 @@ class SmsLogProcessor(LogProcessor):
 
         self.combinedFilePath = os.path.join(self.pathCache, 'combined.tsv')
         self.statsFilePath = os.path.join(self.pathCache, 'combined.json')
+        self.manifestFilePath = os.path.join(self.pathCache, 'downloaded.json')
+        self.indexFilePath = os.path.join(self.pathCache, 'combined-index.json')
+        # Incomplete downloads are kept in a subdir so that they are never treated as logs
+        self.pathPartial = os.path.join(self.pathLogs, '.partial')
+        self._threadData = threading.local()
+        # Logs parsed while downloading, in streamCombine mode: filename -> (parsed file, line count)
+        self.pathStreamed = os.path.join(self.pathCache, 'streamed')
+        self.streamedFiles = {}
 
         if self.settings.downloadOverlapDays and self.settings.lastDownloadTs:
             self.downloadIfAfter = self.settings.lastDownloadTs - timedelta(days=self.settings.downloadOverlapDays)
@@ -80,8 +239,11 @@ class SmsLogProcessor(LogProcessor):
         s.awsPrefix = ''
         s.awsUser = generatePassword()
         s.downloadOverlapDays = 0
+        s.downloadThreads = 4
         s.enableDownload = True
         s.enableDownloadOld = True
+        # Also save the parsed stats as human-readable JSON, next to the binary snapshot that is reloaded
+        s.exportStatsJson = True
         s.lastDownloadTs = False
         s.lastProcessedTs = False
         s.partnerDirMap = {}
@@ -89,6 +251,8 @@ class SmsLogProcessor(LogProcessor):
         s.processOverlapDays = 1
         s.salt = generatePassword()
         s.sortCmd = 'sort'
+        # Parse the logs while they are being downloaded, instead of re-reading them from disk afterwards
+        s.streamCombine = False
         if suffix:
             suffix = suffix.strip('/\\')
         s.pathGraphs = 'graphs' + os.sep + suffix if suffix else ''
@@ -117,23 +281,40 @@ class SmsLogProcessor(LogProcessor):
 
         bucket = cn.get_bucket(self.settings.awsBucket)
         files = bucket.list(self.settings.awsPrefix)
+        manifest = self.loadManifest()
         newDataFound = False
 
+        if not os.path.exists(self.pathPartial):
+            os.mkdir(self.pathPartial)
+        if self.settings.streamCombine:
+            # Remove anything parsed by a previous run that was not combined
+            if os.path.exists(self.pathStreamed):
+                shutil.rmtree(self.pathStreamed)
+            os.mkdir(self.pathStreamed)
+
+        downloads = []
         for key in files:
             filename = key.key[len(self.settings.awsPrefix):]
+            known = manifest.get(filename)
+            if known and known['done'] and known['etag'] == key.etag and known['size'] == key.size:
+                continue  # Same object as the last time we downloaded it
+
             filePath = os.path.join(self.pathLogs, filename)
             fileDate = self.getFileDate(filename)
-            fileExists = os.path.exists(filePath)
+            try:
+                localSize = os.stat(filePath).st_size
+            except OSError:
+                localSize = None
 
             skipReason = False
             dlReason = False
             if key.size == 0:
                 skipReason = u'Skipping empty file %s' % filename
-            elif not fileExists:
+            elif localSize is None:
                 dlReason = u"it doesn't exist"
-            elif key.size != os.stat(filePath).st_size:
+            elif key.size != localSize:
                 dlReason = u'local size %s <> remote %s' % (
-                    locale.format(u'%d', os.stat(filePath).st_size, grouping=True),
+                    locale.format(u'%d', localSize, grouping=True),
                     locale.format(u'%d', key.size, grouping=True))
             elif fileDate and self.downloadIfAfter and fileDate > self.downloadIfAfter:
                 dlReason = u'date is too close to last file date %s' % self.downloadIfAfter
@@ -149,27 +330,143 @@ class SmsLogProcessor(LogProcessor):
                     safePrint(skipReason)
                 continue
 
-            safePrint(u'Downloading %s because %s' % (filename, dlReason))
-            if fileExists:
-                if os.stat(filePath).st_size == 0:
-                    safePrint(u'Removing empty file %s' % filePath)
-                    os.remove(filePath)
-                else:
-                    bakCount = 0
-                    bakFile = filePath + '.bak'
-                    while os.path.exists(bakFile):
-                        bakCount += 1
-                        bakFile = filePath + '.bak' + str(bakCount)
-                    safePrint(u'Renaming %s => %s' % (filePath, bakFile))
-                    os.rename(filePath, bakFile)
-
-            key.get_contents_to_filename(filePath)
-            if fileDate and (not self.settings.lastDownloadTs or self.settings.lastDownloadTs < fileDate):
-                self.settings.lastDownloadTs = fileDate
-            newDataFound = True
+            # Resume the previous download if it was interrupted, and the remote file is still the same
+            partPath = os.path.join(self.pathPartial, filename)
+            resumeFrom = 0
+            if known and not known['done'] and known['etag'] == key.etag and os.path.isfile(partPath):
+                resumeFrom = os.stat(partPath).st_size
+                if resumeFrom >= key.size:
+                    resumeFrom = 0
+            manifest[filename] = {u'etag': key.etag, u'size': key.size, u'done': False}
+
+            safePrint(u'Downloading %s because %s%s' % (
+                filename, dlReason, u' (resuming from %d)' % resumeFrom if resumeFrom else u''))
+            downloads.append((key.key, key.etag, key.size, filePath, partPath, localSize, resumeFrom))
+
+        if not downloads:
+            return newDataFound
+        self.saveManifest(manifest)
+
+        pool = ThreadPool(max(1, self.settings.downloadThreads))
+        try:
+            for filename, streamed in pool.imap_unordered(self._downloadFile, downloads):
+                if streamed:
+                    self.streamedFiles[filename] = streamed
+                manifest[filename][u'done'] = True
+                self.saveManifest(manifest)
+                fileDate = self.getFileDate(filename)
+                if fileDate and (not self.settings.lastDownloadTs or self.settings.lastDownloadTs < fileDate):
+                    self.settings.lastDownloadTs = fileDate
+                newDataFound = True
+        finally:
+            pool.close()
+            pool.join()
 
         return newDataFound
 
+    def _getBucket(self):
+        # boto connections should not be shared between threads
+        bucket = getattr(self._threadData, 'bucket', None)
+        if bucket is None:
+            cn = S3Connection(self.settings.awsKeyId, self.settings.awsSecret, proxy=self.proxy,
+                              proxy_port=self.proxyPort)
+            bucket = cn.get_bucket(self.settings.awsBucket, validate=False)
+            self._threadData.bucket = bucket
+        return bucket
+
+    def _downloadFile(self, download):
+        """
+        Download one S3 key into a temp file, and move it into the logs dir once complete
+        In the streamCombine mode, the data is also parsed into a file in the streamed dir as it arrives
+        :return: filename of the downloaded file, and (parsed file, line count) or None
+        """
+        keyName, etag, size, filePath, partPath, localSize, resumeFrom = download
+        filename = os.path.basename(filePath)
+        key = self._getBucket().new_key(keyName)
+        headers = {'If-Match': etag}
+        if resumeFrom:
+            headers['Range'] = 'bytes=%d-' % resumeFrom
+        streamed = None
+        with open(partPath, 'ab' if resumeFrom else 'wb') as f:
+            if self.settings.streamCombine:
+                streamedPath = os.path.join(self.pathStreamed, filename + '.tsv')
+                with io.open(streamedPath, 'w', encoding='utf8') as dst:
+                    joiner = RecordJoiner(dst)
+                    writer = StreamingLogWriter(f, joiner, filename.endswith('.gz'))
+                    if resumeFrom:
+                        # Parse the part we already have before the rest of it arrives
+                        with open(partPath, 'rb') as existing:
+                            for chunk in iter(lambda: existing.read(1024 * 1024), b''):
+                                writer.parse(chunk)
+                    key.get_contents_to_file(writer, headers=headers)
+                    writer.close()
+                streamed = (streamedPath, joiner.count)
+            else:
+                key.get_contents_to_file(f, headers=headers)
+        downloadedSize = os.stat(partPath).st_size
+        if downloadedSize != size:
+            raise IOError(u'Downloaded %d bytes instead of %d for %s' % (downloadedSize, size, filename))
+
+        if localSize == 0:
+            safePrint(u'Removing empty file %s' % filePath)
+            os.remove(filePath)
+        elif localSize is not None:
+            bakCount = 0
+            bakFile = filePath + '.bak'
+            while os.path.exists(bakFile):
+                bakCount += 1
+                bakFile = filePath + '.bak' + str(bakCount)
+            safePrint(u'Renaming %s => %s' % (filePath, bakFile))
+            os.rename(filePath, bakFile)
+        os.rename(partPath, filePath)
+        safePrint(u'Downloaded %s' % filename)
+        return filename, streamed
+
+    def loadManifest(self):
+        """
+        :return: dict of filename -> {etag, size, done} of the downloaded S3 keys
+        """
+        return loadJson(self.manifestFilePath, {})
+
+    def saveManifest(self, manifest):
+        saveJson(self.manifestFilePath, manifest)
+
+    def getFingerprint(self, filePath):
+        """
+        Identify a processed log file, so that next time we can tell if it has changed or was appended to
+        :return: {size, mtime, head, tail, offset}. Offset is the start of the last record - if more data gets
+                 appended, we need to re-process from that point because the last record could have more lines
+        """
+        st = os.stat(filePath)
+        if filePath.endswith('.gz'):
+            # Compressed files can't be processed from the middle
+            offset = 0
+        else:
+            with io.open(filePath, 'rb') as f:
+                offset = findLastRecordStart(f, st.st_size)
+        return {
+            u'size': st.st_size,
+            u'mtime': st.st_mtime,
+            u'head': hashFileRange(filePath, 0, fingerprintBlockSize),
+            u'tail': hashFileRange(filePath, offset - fingerprintBlockSize, offset),
+            u'offset': offset,
+        }
+
+    def getUnprocessedOffset(self, filePath, fingerprint):
+        """
+        Compare the file with its fingerprint from the last time it was processed
+        :return: False if the file has not changed, otherwise the offset from which to process it
+        """
+        st = os.stat(filePath)
+        if st.st_size == fingerprint[u'size'] and st.st_mtime == fingerprint[u'mtime']:
+            return False
+        offset = fingerprint[u'offset']
+        if offset > 0 and st.st_size >= offset and \
+                hashFileRange(filePath, 0, fingerprintBlockSize) == fingerprint[u'head'] and \
+                hashFileRange(filePath, offset - fingerprintBlockSize, offset) == fingerprint[u'tail']:
+            return offset
+        return 0
+
     def combineDataFiles(self):
 
         sourceFiles = os.listdir(self.pathLogs)
@@ -183,43 +480,71 @@ class SmsLogProcessor(LogProcessor):
             safePrint(u'Processing all files')
 
         tempFile = self.combinedFilePath + '.tmp'
-        manualLogRe = re.compile(r'^wikipedia_application_\d+\.log\.\d+\.gz:')
+        readBatchSize = 4 * 1024 * 1024
+
+        # Fingerprints of the files that went into the combined file - filename -> getFingerprint()
+        index = loadJson(self.indexFilePath, {}) if os.path.isfile(self.combinedFilePath) else {}
+        index = dict((k, v) for k, v in index.iteritems() if k in sourceFiles)
 
         totalCount = 0
+        streamedFiles = []
         with io.open(tempFile, 'w', encoding='utf8') as dst:
             for srcFile in sourceFiles:
 
+                srcFilePath = os.path.join(self.pathLogs, srcFile)
                 fileDate = self.getFileDate(srcFile)
-                if self.processIfAfter:
+                if srcFile in index and os.path.isfile(srcFilePath):
+                    offset = self.getUnprocessedOffset(srcFilePath, index[srcFile])
+                    if offset is False:
+                        continue  # this file has not changed since we processed it
+                elif self.processIfAfter:
                     if not fileDate:
                         continue  # old style filename, and the processIfAfter is set
                     elif fileDate <= self.processIfAfter:
                         continue  # we have already processed this file
-
-                srcFilePath = os.path.join(self.pathLogs, srcFile)
-                if not os.path.isfile(srcFilePath):
-                    safePrint(u'File %s was not found, skipping' % srcFilePath)
-                    continue
-                last = False
-                count = 0
-                for line in io.open(srcFilePath, 'r', encoding='utf8'):
-                    count += 1
-                    totalCount += 1
-                    if count == 1 or totalCount % 30000 == 0:
-                        safePrint(u'File %s, line %d, total lines %d' % (srcFile, count - 1, totalCount - 1))
-
-                    l = line.strip(u'\n\r')
-                    l = manualLogRe.sub('', l, 1)
-                    if u' WIKI\t' in l:
-                        writeLine(dst, last)
-                        last = l
-                    elif len(l) > 2 and l[0] == u'2' and l[1] == u'0':
-                        writeLine(dst, last)
-                        last = False
-                    elif isinstance(last, basestring):
-                        last = last + u'\t' + l
-
-                writeLine(dst, last)
+                    offset = 0
+                else:
+                    offset = 0
+
+                if srcFile in self.streamedFiles:
+                    # Already parsed while downloading
+                    streamedFile, count = self.streamedFiles[srcFile]
+                    safePrint(u'File %s was parsed during download, %d lines' % (srcFile, count))
+                    streamedFiles.append(streamedFile)
+                    totalCount += count
+                    self.addStageRows(count)
+                else:
+                    if not os.path.isfile(srcFilePath):
+                        safePrint(u'File %s was not found, skipping' % srcFilePath)
+                        continue
+                    raw = io.open(srcFilePath, 'rb', buffering=readBatchSize)
+                    if srcFile.endswith('.gz'):
+                        lines = io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(fileobj=raw), readBatchSize),
+                                                 encoding='utf8')
+                    else:
+                        if offset:
+                            raw.seek(offset)
+                        lines = io.TextIOWrapper(raw, encoding='utf8')
+                    joiner = RecordJoiner(dst)
+                    if offset:
+                        safePrint(u'File %s was appended to, processing from %d' % (srcFile, offset))
+                    safePrint(u'File %s, total lines %d' % (srcFile, totalCount))
+                    diagnostics = self.createDiagnostics(srcFile, os.path.getsize(srcFilePath) - offset)
+                    fileCount = 0
+                    with lines, raw:
+                        while True:
+                            batch = lines.readlines(readBatchSize)
+                            if not batch:
+                                break
+                            joiner.feedLines(batch)
+                            fileCount += len(batch)
+                            diagnostics.progress(fileCount, raw.tell() - offset)
+                    totalCount += fileCount
+                    joiner.close()
+                    self.addStageRows(fileCount)
+                    diagnostics.report()
+
+                index[srcFile] = self.getFingerprint(srcFilePath)
                 if fileDate and (not self.settings.lastProcessedTs or self.settings.lastProcessedTs < fileDate):
                     self.settings.lastProcessedTs = fileDate
 
@@ -229,7 +554,7 @@ class SmsLogProcessor(LogProcessor):
             if os.path.exists(sortedOutputFile):
                 os.remove(sortedOutputFile)
 
-            args = [self.settings.sortCmd, '-u', '-o', sortedOutputFile, tempFile]
+            args = [self.settings.sortCmd, '-u', '-o', sortedOutputFile, tempFile] + streamedFiles
             originalExists = os.path.exists(self.combinedFilePath)
             if originalExists:
                 args.append(self.combinedFilePath)
@@ -253,31 +578,40 @@ class SmsLogProcessor(LogProcessor):
                 raise Exception(u'Error %s running %s\nOutput:\n%s' % (ex.returncode, cmd, ex.output))
 
         os.remove(tempFile)
+        for streamedFile in streamedFiles:
+            os.remove(streamedFile)
+        self.streamedFiles = {}
+        saveJson(self.indexFilePath, index)
 
     def generateGraphData(self, skipParsing=False):
         stats = smsgraphs.Stats(self.combinedFilePath, self.pathGraphs, self.statsFilePath, self.settings.partnerMap,
                                 self.settings.partnerDirMap, self.settings.salt)
         if not skipParsing:
             safePrint(u'\nParsing data')
-            stats.process()
-            stats.pickle()
+            with self.stage('process'):
+                stats.process(self.settings.parallelProcesses)
+                stats.pickle(self.settings.exportStatsJson)
         else:
             safePrint(u'Loading parsed data')
-            stats.unpickle()
+            with self.stage('unpickle'):
+                stats.unpickle()
 
         safePrint(u'Generating data files to %s' % self.pathGraphs)
         # stats.dumpStats()
-        stats.createGraphs()
+        with self.stage('createGraphs'):
+            stats.createGraphs(self.settings.parallelProcesses)
 
     def run(self):
         newDataFound = True
         if self.settings.enableDownload:
-            newDataFound = self.download()
+            with self.stage('download'):
+                newDataFound = self.download()
 
         if not newDataFound and os.path.isfile(self.combinedFilePath):
             safePrint('No new data, we are done')
         else:
-            self.combineDataFiles()
+            with self.stage('combineDataFiles'):
+                self.combineDataFiles()
             self.generateGraphData()
 
 
@@ -0,0 +1,66 @@
+import gzip
+import io
+import unittest
+
+from smslogs import StreamingLogWriter
+
+
+class LineCollector(object):
+    """
+    Replaces the RecordJoiner - keeps the lines it is fed
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def feed(self, line):
+        self.lines.append(line)
+
+    def feedLines(self, lines):
+        self.lines.extend(lines)
+
+    def close(self):
+        pass
+
+
+def gzipMember(text):
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as f:
+        f.write(text.encode('utf8'))
+    return data.getvalue()
+
+
+def streamLines(data, blockSize):
+    collector = LineCollector()
+    raw = io.BytesIO()
+    writer = StreamingLogWriter(raw, collector, True)
+    for pos in xrange(0, len(data), blockSize):
+        writer.write(data[pos:pos + blockSize])
+    writer.close()
+    assert raw.getvalue() == data
+    return collector.lines
+
+
+def gzipFileLines(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+        return f.read().decode('utf8').splitlines()
+
+
+class StreamingLogWriterTest(unittest.TestCase):
+    def test_concatenated_members(self):
+        data = gzipMember(u'first line\nsecond line\n') + gzipMember(u'third line\nfourth \xe9\n')
+        expected = [u'first line', u'second line', u'third line', u'fourth \xe9']
+        self.assertEqual(gzipFileLines(data), expected)
+        # Split the members at every possible place between the writes
+        for blockSize in (1, 7, 16, len(data)):
+            self.assertEqual(streamLines(data, blockSize), expected)
+
+    def test_zero_padding_between_members(self):
+        data = gzipMember(u'a\n') + b'\x00' * 5 + gzipMember(u'b\n') + b'\x00' * 3
+        self.assertEqual(gzipFileLines(data), [u'a', u'b'])
+        for blockSize in (1, 3, len(data)):
+            self.assertEqual(streamLines(data, blockSize), [u'a', u'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
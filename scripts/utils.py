@@ -1,5 +1,6 @@
 import sys
 import csv
+import itertools
 
 """
 This code was adapted from http://python3porting.com/problems.html#csv-api-changes
@@ -7,30 +8,110 @@ This code was adapted from http://python3porting.com/problems.html#csv-api-chang
 
 PY3 = sys.version > '3'
 
+# Rows are converted in blocks of this many rows, and files are opened with this buffer size
+blockSize = 10000
+bufferSize = 1 << 20
+
+# The csv module refuses NUL bytes in its input, so it can safely join all the cells of a block
+# before decoding them in a single call
+cellSeparator = '\x00'
+
+
+def decodeRows(rows, encoding):
+    """
+    Decode a list of byte string rows into unicode rows with a single decode call
+    """
+    cells = cellSeparator.join([cellSeparator.join(row) for row in rows if row])
+    cells = cells.decode(encoding).split(cellSeparator.decode(encoding))
+    result = []
+    pos = 0
+    for row in rows:
+        end = pos + len(row)
+        result.append(cells[pos:end])
+        pos = end
+    return result
+
+
+def encodeRows(rows, encoding):
+    """
+    Encode a list of unicode rows into byte string rows. Falls back to encoding each cell
+    if some of the values contain the separator.
+    """
+    sep = cellSeparator.decode(encoding)
+    cells = sep.join([sep.join(row) for row in rows if row]).encode(encoding).split(cellSeparator)
+    if len(cells) != sum([len(row) for row in rows if row]):
+        return [[s.encode(encoding) for s in row] for row in rows]
+    result = []
+    pos = 0
+    for row in rows:
+        end = pos + len(row)
+        result.append(cells[pos:end])
+        pos = end
+    return result
+
 
 class CsvUnicodeReader:
-    def __init__(self, filename, dialect=csv.excel, encoding="utf-8", **kw):
+    def __init__(self, filename, dialect=csv.excel, encoding="utf-8", header=False, **kw):
+        """
+        :param header: if True, the first row is read as is into self.header and is not returned
+        """
         self.filename = filename
         self.dialect = dialect
         self.encoding = encoding
+        self.hasHeader = header
+        self.header = None
         self.kw = kw
+        self.pending = []
+        self.pendingPos = 0
 
     def __enter__(self):
         if PY3:
-            self.f = open(self.filename, 'rt', encoding=self.encoding, newline='')
+            self.f = open(self.filename, 'rt', encoding=self.encoding, newline='', buffering=bufferSize)
         else:
-            self.f = open(self.filename, 'rb')
+            self.f = open(self.filename, 'rb', bufferSize)
         self.reader = csv.reader(self.f, dialect=self.dialect, **self.kw)
+        if self.hasHeader:
+            row = next(self.reader, None)
+            if row is not None and not PY3:
+                row = [s.decode(self.encoding) for s in row]
+            self.header = row
         return self
 
     def __exit__(self, type, value, traceback):
         self.f.close()
 
+    def readRawRows(self, count=blockSize):
+        """
+        Read up to count rows without decoding them - byte strings on Python 2
+        """
+        return list(itertools.islice(self.reader, count))
+
+    def _readBlock(self, count):
+        rows = self.readRawRows(count)
+        if rows and not PY3:
+            rows = decodeRows(rows, self.encoding)
+        return rows
+
+    def readrows(self, count=blockSize):
+        """
+        Read up to count rows at once. Returns an empty list at the end of the file.
+        """
+        pos = self.pendingPos
+        rows = self.pending[pos:pos + count]
+        self.pendingPos = pos + len(rows)
+        if len(rows) < count:
+            rows.extend(self._readBlock(count - len(rows)))
+        return rows
+
     def next(self):
-        row = next(self.reader)
-        if PY3:
-            return row
-        return [s.decode("utf-8") for s in row]
+        if self.pendingPos >= len(self.pending):
+            self.pending = self._readBlock(blockSize)
+            self.pendingPos = 0
+            if not self.pending:
+                raise StopIteration()
+        row = self.pending[self.pendingPos]
+        self.pendingPos += 1
+        return row
 
     __next__ = next
 
@@ -47,9 +128,9 @@ class CsvUnicodeWriter:
 
     def __enter__(self):
         if PY3:
-            self.f = open(self.filename, 'wt', encoding=self.encoding, newline='')
+            self.f = open(self.filename, 'wt', encoding=self.encoding, newline='', buffering=bufferSize)
         else:
-            self.f = open(self.filename, 'wb')
+            self.f = open(self.filename, 'wb', bufferSize)
         self.writer = csv.writer(self.f, dialect=self.dialect, **self.kw)
         return self
 
@@ -62,5 +143,14 @@ class CsvUnicodeWriter:
         self.writer.writerow(row)
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        """
+        Write rows in blocks, encoding each block at once
+        """
+        rows = iter(rows)
+        while True:
+            block = list(itertools.islice(rows, blockSize))
+            if not block:
+                break
+            if not PY3:
+                block = encodeRows(block, self.encoding)
+            self.writer.writerows(block)
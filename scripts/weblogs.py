@@ -1,10 +1,9 @@
 # coding=utf-8
 import StringIO
-import gzip
 import re
 import collections
 import sys
-from pandas import read_table, pivot_table
+from pandas import pivot_table
 from pandas.core.frame import DataFrame, Series
 import numpy as np
 
@@ -21,11 +20,25 @@ def addStat(stats, date, dataType, xcs, via, ipset, https, lang, subdomain, site
 
 
 columnHdrCache = u'date,type,xcs,via,ipset,https,lang,subdomain,site,count'.split(',')
+schemaCache = columnHdrCache[:-1] + [(u'count', int)]
 columnHdrResult = u'date,type,xcs,via,ipset,https,lang,subdomain,site,iszero,ison,count'.split(',')
+graphColumns = u'date,xcs,via,iszero,ison,lang'.split(',')
 validSubDomains = {'m', 'zero', 'mobile', 'wap'}
 validHttpCode = {'200', '304'}
 
 
+def removeExtraXcs(vals, filename):
+    """
+    Repair the rows of the old cache files that have an extra empty column after the xcs
+    :return: fixed row, or None if it cannot be repaired
+    """
+    if len(vals) == 11 and vals[3] == '':
+        safePrint('Fixing extra empty xcs in file %s' % filename)
+        del vals[3]
+        return vals
+    return None
+
+
 class WebLogProcessor(LogProcessor):
     def __init__(self, settingsFile='settings/weblogs.json', logDatePattern=False):
         super(WebLogProcessor, self).__init__(settingsFile, 'web')
@@ -127,24 +140,22 @@ class WebLogProcessor(LogProcessor):
         stats = {}
         count = 0
 
-        if logFile.endswith('.gz'):
-            streamData = io.TextIOWrapper(io.BufferedReader(gzip.open(logFile)), encoding='utf8', errors='ignore')
-        else:
-            streamData = io.open(logFile, 'r', encoding='utf8', errors='ignore')
+        diagnostics = self.createDiagnostics(logFile, os.path.getsize(logFile))
+        streamData, rawFile = openLogFile(logFile)
         for line in streamData:
             count += 1
-            if count % 1000000 == 0:
-                safePrint('%d lines processed' % count)
+            if count % 10000 == 0:
+                diagnostics.progress(count, rawFile.tell())
 
             l = line.strip('\n\r').split('\t')
 
             if len(l) < 16:
-                safePrint(u'String too short - %d parts\n%s' % (len(l), line))
+                diagnostics.error(u'String too short', line, unicode(len(l)))
                 addStat(stats, fileDt, 'ERR', '000-00', 'ERR', 'ERR', False, '', 'short-str', str(len(l)))
                 continue
             analytics = l[-1]
             if '=' not in analytics:  # X-Analytics should have at least some values
-                safePrint(u'Analytics is not valid - "%s"\n%s' % (analytics, line))
+                diagnostics.error(u'Analytics is not valid', line, analytics)
                 addStat(stats, fileDt, 'ERR', '000-00', 'ERR', 'ERR', False, '', 'analytics', '')
                 continue
             verb = l[7]
@@ -155,7 +166,7 @@ class WebLogProcessor(LogProcessor):
                 xcs = None
             tmp = l[5].split('/')
             if len(tmp) != 2:
-                safePrint(u'Invalid status - "%s"\n%s' % (l[5], line))
+                diagnostics.error(u'Invalid status', line, l[5])
                 addStat(stats, fileDt, 'ERR', '000-00', 'ERR', 'ERR', False, '', 'status', '')
                 continue
             (cache, httpCode) = tmp
@@ -172,7 +183,7 @@ class WebLogProcessor(LogProcessor):
                     url = url[len(m.group(1)):]
             m = self.urlRe.match(url)
             if not m:
-                safePrint(u'URL parsing failed: "%s"\n%s' % (url, line))
+                diagnostics.error(u'URL parsing failed', line, url)
                 addStat(stats, fileDt, 'ERR', xcs, via, ipset, https, '', 'url', '')
                 continue
             host = m.group(1)
@@ -200,7 +211,7 @@ class WebLogProcessor(LogProcessor):
                 site = ''
 
             if hostParts or False == hostParts:
-                safePrint(u'Unknown host %s\n%s' % (host, line))
+                diagnostics.error(u'Unknown host', line, host)
                 addStat(stats, fileDt, 'ERR', xcs, via, ipset, https, '', 'host', host)
                 continue
 
@@ -220,6 +231,12 @@ class WebLogProcessor(LogProcessor):
             # Valid request!
             addStat(stats, dt, 'DATA', xcs, via, ipset, https, lang, subdomain, site)
 
+        diagnostics.progress(count, rawFile.tell())
+        streamData.close()
+        rawFile.close()
+        diagnostics.report()
+        self.addStageRows(count)
+
         writeData(statFile, [list(k) + [v] for k, v in stats.iteritems()], columnHdrCache)
 
     def combineStats(self):
@@ -231,16 +248,12 @@ class WebLogProcessor(LogProcessor):
         for f in os.listdir(self.pathCache):
             if not self.statFileRe.match(f):
                 continue
-            for vals in readData(os.path.join(self.pathCache, f), columnHdrCache):
+            statFile = os.path.join(self.pathCache, f)
+            for vals in readData(statFile, columnHdrCache, schema=schemaCache,
+                                 repairRow=lambda v: removeExtraXcs(v, statFile)):
                 # "0          1    2      3      4       5    6  7    8         9"
                 # "2014-07-25 DATA 250-99 DIRECT default http ru zero wikipedia 1000"
-                if len(vals) != 10:
-                    if len(vals) == 11 and vals[3] == '':
-                        safePrint('Fixing extra empty xcs in file %s' % f)
-                        del vals[3]
-                    else:
-                        raise ValueError('Unrecognized key (%s) in file %s' % (joinValues(vals), f))
-                (dt, typ, xcs, via, ipset, https, lang, subdomain, site, count) = vals
+                (dateStr, typ, xcs, via, ipset, https, lang, subdomain, site, count) = vals
 
                 error = False
 
@@ -248,13 +261,13 @@ class WebLogProcessor(LogProcessor):
                     error = 'bad-site'
                 elif xcs in configs:
                     if xcs == '404-01b':
-                        vals[2] = xcs = '404-01'
-                        vals[4] = ipset = 'b'
+                        xcs = '404-01'
+                        ipset = 'b'
 
                     isZero = ''
                     isOn = ''
                     if typ == 'DATA':
-                        dt = datetime.strptime(dt, '%Y-%m-%d')
+                        dt = datetime.strptime(dateStr, '%Y-%m-%d')
                         site2 = subdomain + '.' + site
                         isZero = False
                         isEnabled = False
@@ -274,17 +287,15 @@ class WebLogProcessor(LogProcessor):
                         isZero = u'yes' if isZero else u'no'
                         isOn = u'on' if isEnabled else u'off'
 
-                    vals[9] = isZero
-                    vals[10] = isOn
+                    key = (dateStr, typ, xcs, via, ipset, https, lang, subdomain, site, isZero, isOn)
                 else:
                     # X-CS does not exist, ignore it
                     error = 'xcs'
 
                 if error:
-                    vals = (vals[0], 'ERR', '000-00', 'ERR', 'ERR', 'http', '', error, '', '', '')
+                    key = (dateStr, 'ERR', '000-00', 'ERR', 'ERR', 'http', '', error, '', '', '')
 
-                key = tuple(vals)
-                stats[key] += int(count)
+                stats[key] += count
 
         # convert {"a|b|c":count,...}  into [[a,b,c,count],...]
 
@@ -297,13 +308,15 @@ class WebLogProcessor(LogProcessor):
 
         wiki = self.getWiki()
 
+        # filter type==DATA and site==wikipedia
+        isWikipediaData = lambda d: (d['type'] == 'DATA') & (d['site'] == 'wikipedia')
         if stats is None:
-            allData = read_table(self.combinedFile, sep='\t')
+            # Only the columns used by the graphs are kept, summed while reading the file in chunks
+            allData = readAggregatedTable(self.combinedFile, graphColumns, isWikipediaData,
+                                          self.settings.readChunkRows)
         else:
             allData = DataFrame(stats, columns=columnHdrResult)
-
-        # filter type==DATA and site==wikipedia
-        allData = allData[(allData['type'] == 'DATA') & (allData['site'] == 'wikipedia')]
+            allData = allData[isWikipediaData(allData)]
         # filter out last date
         lastDate = allData.date.max()
         df = allData[allData.date < lastDate]
@@ -321,24 +334,27 @@ class WebLogProcessor(LogProcessor):
             token=wiki.token()
         )
 
-        for xcs in list(df.xcs.unique()):
+        # create an artificial yes/opera value
+        opera = df[(df.via == 'OPERA') & (df.iszero == 'yes')]
+        opera['str'] = 'zero-opera'
 
-            xcsDf = df[df.xcs == xcs]
+        yes = df[df.iszero == 'yes']
+        yes['str'] = 'zero-all'
 
-            # create an artificial yes/opera value
-            opera = xcsDf[(xcsDf.via == 'OPERA') & (xcsDf.iszero == 'yes')]
-            opera['str'] = 'zero-opera'
+        no = df[df.iszero == 'no']
+        no['str'] = 'non-zero'
 
-            yes = xcsDf[xcsDf.iszero == 'yes']
-            yes['str'] = 'zero-all'
+        combined = opera.append(yes).append(no)
 
-            no = xcsDf[xcsDf.iszero == 'no']
-            no['str'] = 'non-zero'
+        # Sum each metric for all the carriers at once, and split the result by carrier
+        totalsByXcs = dict(list(combined.groupby(['xcs', 'date', 'str'])['count'].sum().groupby(level=0)))
+        langsByXcs = dict(list(df.groupby(['xcs', 'lang'])['count'].sum().groupby(level=0)))
 
-            combined = opera.append(yes).append(no)
+        for xcs in list(df.xcs.unique()):
 
             s = StringIO.StringIO()
-            pivot_table(combined, 'count', ['date', 'str'], aggfunc=np.sum).to_csv(s, header=False)
+            if xcs in totalsByXcs:
+                totalsByXcs[xcs].reset_index(level=0, drop=True).to_csv(s, header=False)
             result = 'date,iszero,count\n' + s.getvalue()
 
             wiki(
@@ -350,7 +366,7 @@ class WebLogProcessor(LogProcessor):
             )
 
 
-            byLang = pivot_table(xcsDf, 'count', ['lang'], aggfunc=np.sum).order('count', ascending=False)
+            byLang = langsByXcs[xcs].reset_index(level=0, drop=True).order('count', ascending=False)
             top = byLang.head(5)
             other = byLang.sum() - top.sum()
             s = StringIO.StringIO()
@@ -376,14 +392,18 @@ class WebLogProcessor(LogProcessor):
             # ifilter(lambda v: v[1] == 'DATA', stats), columnHeaders11)
 
     def run(self):
-        self.processLogFiles()
+        with self.stage('processLogFiles'):
+            self.processLogFiles()
         if not self.enableUpload:
             safePrint('Uploading disabled, quiting')
         elif os.path.isfile(self.combinedFile):
             safePrint('No new data, we are done')
         else:
-            stats = self.combineStats()
-            self.generateGraphData(stats)
+            with self.stage('combineStats'):
+                stats = self.combineStats()
+                self.addStageRows(len(stats))
+            with self.stage('generateGraphData'):
+                self.generateGraphData(stats)
 
     def manualRun(self):
         # prc.reformatArch()
@@ -1,22 +1,30 @@
 # coding=utf-8
 import StringIO
+import csv
+import itertools
+import mmap
 import re
 import collections
 import subprocess
+from multiprocessing.pool import ThreadPool
 from time import strftime
 from calendar import monthrange
 
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 
-from pandas import read_table, pivot_table, DataFrame, MultiIndex
+from pandas import read_table, concat, to_datetime, MultiIndex
 # from pandas.core.frame import DataFrame
 import numpy as np
 
 from logprocessor import *
+from utils import decodeRows
 
 columnHdrCache = u'xcs,via,ipset,https,lang,subdomain,site,count'.split(',')
 columnHdrResult = u'date,xcs,via,ipset,https,lang,subdomain,site,iszero,ison,count'.split(',')
+graphColumns = u'date,xcs,via,iszero,ison,subdomain,lang'.split(',')
+# Increase when isGraphData() or the layout of the saved cube changes, so that the saved cubes are rebuilt
+cubeVersion = 1
 
 launchedOn = {
     # '123-45': '2006-03-01',
@@ -116,6 +124,86 @@ def insertMissingVals(lines, dateFunc):
     return lines + extraLines
 
 
+def mapFile(fp):
+    """
+    Memory-map an open file for reading. On file systems without mmap support the content is
+    copied into an anonymous map instead. Returns None for an empty file, the caller must close the map.
+    """
+    size = os.fstat(fp.fileno()).st_size
+    if not size:
+        return None
+    try:
+        return mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, EnvironmentError):
+        # Some FUSE mounts do not support mmap
+        mapped = mmap.mmap(-1, size)
+        mapped.write(fp.read())
+        mapped.seek(0)
+        return mapped
+
+
+def sumPartitionFile(filename, stats):
+    """
+    Add the counts from one Hive output file to stats, keyed by the undecoded key columns.
+    The file is parsed line by line straight from the map, without copying it into a string.
+    """
+    colCount = len(columnHdrCache)
+    with open(filename, 'rb') as fp:
+        mapped = mapFile(fp)
+    if mapped is None:
+        return
+    try:
+        lines = iter(mapped.readline, '')
+        if mapped.find('"') >= 0 or mapped.find('\r') >= 0 or mapped.find('\x00') >= 0:
+            # Quoted values and other line endings need the csv module
+            for vals in csv.reader(lines, csv.excel, delimiter='\t'):
+                if len(vals) != colCount:
+                    checkColumnCount(filename, colCount, decodeRows([vals], 'utf-8')[0])
+                stats[tuple(vals[:-1])] += int(vals[-1])
+            return
+        # Most keys repeat, so sum the counts by the whole key line first, and only split the distinct keys
+        fileStats = collections.defaultdict(int)
+        for line in lines:
+            key, sep, count = line.rpartition('\t')
+            fileStats[key] += int(count)
+    finally:
+        mapped.close()
+    for key, count in fileStats.iteritems():
+        vals = key.split('\t')
+        if len(vals) != colCount - 1:
+            checkColumnCount(filename, colCount, decodeRows([vals + [str(count)]], 'utf-8')[0])
+        stats[tuple(vals)] += count
+
+
+def readPartitionFiles(datePath, fileRe):
+    """
+    Sum the counts of all the Hive output files in one date=YYYY-MM-DD directory
+    :return: {(xcs, via, ipset, https, lang, subdomain, site): count} with byte string keys
+    """
+    stats = collections.defaultdict(int)
+    for f in os.listdir(datePath):
+        if fileRe.match(f):
+            sumPartitionFile(os.path.join(datePath, f), stats)
+    return stats
+
+
+def isGraphData(data):
+    """
+    Rows of the combined file used by the graphs - no error and test xcs, and only site==wikipedia
+    """
+    return (data['site'] == 'wikipedia') & (data['xcs'] != 'ERROR') & (data['xcs'] != '000-00') & \
+        ~data['xcs'].str.startswith('TEST')
+
+
+def rollUp(cube, keys, mask=None):
+    """
+    Sum the counts of the cube by some of its key columns, optionally only for the rows in mask
+    """
+    if mask is not None:
+        cube = cube[mask]
+    return cube.groupby(keys, as_index=False)['count'].sum()
+
+
 class WebLogProcessor2(LogProcessor):
     def __init__(self, settingsFile):
         print('Using settings %s' % settingsFile)
@@ -125,6 +213,9 @@ class WebLogProcessor2(LogProcessor):
         self.dateDirRe = re.compile(r'^date=(\d\d\d\d-\d\d-\d\d)$')
         self.fileRe = re.compile(r'^\d+')
         self.combinedFile = os.path.join(self.pathCache, 'combined-all.tsv')
+        # combined-all.tsv counts summed by graphColumns, all the RawData pages are computed from it
+        self.cubeFile = os.path.join(self.pathCache, 'combined-cube.tsv')
+        self.cubeInfoFile = self.cubeFile + '.json'
         self.allowEdit = True
 
     def defaultSettings(self, suffix):
@@ -134,6 +225,8 @@ class WebLogProcessor2(LogProcessor):
         s.dstTable = 'zero_webstats'
         s.hqlScript = 'zero-counts.hql'
         s.wikiPageSuffix = ''
+        # Number of date partitions read at the same time - reading from the HDFS mount is mostly waiting
+        s.readThreads = 8
         return s
 
     def onSavingSettings(self):
@@ -244,20 +337,24 @@ class WebLogProcessor2(LogProcessor):
         ignoreViaBefore = datetime(2014, 3, 22)
         configs = self.downloadConfigs()
         stats = collections.defaultdict(int)
+        partitions = []
         for dateDir in os.listdir(self.pathLogs):
             m = self.dateDirRe.match(dateDir)
-            if not m:
-                continue
-            dateStr = m.group(1)
-            dt = datetime.strptime(dateStr, '%Y-%m-%d')
-            datePath = os.path.join(self.pathLogs, dateDir)
-            for f in os.listdir(datePath):
-                if not self.fileRe.match(f):
-                    continue
-                for vals in readData(os.path.join(datePath, f), -len(columnHdrCache)):
-                    # 0      1      2       3    4  5    6         7
-                    # 250-99 DIRECT default http ru zero wikipedia 1000
-                    (xcs, via, ipset, https, lang, subdomain, site, count) = vals
+            if m:
+                partitions.append((m.group(1), os.path.join(self.pathLogs, dateDir)))
+
+        pool = ThreadPool(max(1, min(self.settings.readThreads, len(partitions))))
+        try:
+            results = pool.imap(lambda p: readPartitionFiles(p[1], self.fileRe), partitions)
+            for (dateStr, _), partStats in itertools.izip(partitions, results):
+                dt = datetime.strptime(dateStr, '%Y-%m-%d')
+                # The configs are only evaluated once for each distinct key of the partition
+                keys = partStats.keys()
+                for key, vals in zip(keys, decodeRows(keys, 'utf-8')):
+                    count = partStats[key]
+                    # 0      1      2       3    4  5    6
+                    # 250-99 DIRECT default http ru zero wikipedia
+                    (xcs, via, ipset, https, lang, subdomain, site) = vals
 
                     via = via.upper() if via else u'DIRECT'
                     ipset = ipset if ipset else u'default'
@@ -266,8 +363,8 @@ class WebLogProcessor2(LogProcessor):
                     error = False
 
                     if xcs == '404-01b':
-                        vals[2] = xcs = '404-01'
-                        vals[4] = ipset = 'b'
+                        xcs = '404-01'
+                        ipset = 'b'
 
                     if site not in validSites:
                         error = 'bad-site'
@@ -302,7 +399,10 @@ class WebLogProcessor2(LogProcessor):
                     if error:
                         vals = (dateStr, 'ERROR', 'ERR', 'ERR', 'http', '', error, '', '', '')
 
-                    stats[vals] += int(count)
+                    stats[vals] += count
+        finally:
+            pool.close()
+            pool.join()
 
         stats = [list(k) + [v] for k, v in stats.iteritems()]
         writeData(self.combinedFile, stats, columnHdrResult)
@@ -310,49 +410,42 @@ class WebLogProcessor2(LogProcessor):
     def generateGraphData(self):
         safePrint('Generating and uploading data files')
 
-        allData = read_table(self.combinedFile, sep='\t', na_filter=False, parse_dates=[0], infer_datetime_format=True)
-        xcsList = [xcs for xcs in allData.xcs.unique() if xcs != 'ERROR' and xcs[0:4] != 'TEST' and xcs != '000-00']
-
-        # filter type==DATA and site==wikipedia
-        allData = allData[(allData['xcs'].isin(xcsList)) & (allData['site'] == 'wikipedia')]
+        cube = self.loadCube()
 
         # By "iszero+via", e.g.  a,b,aO,bO,..., where 'a' == zero-rated, 'b' == non-zero-rated, and 'O' == Opera
-        data = DataFrame(pivot_table(allData, 'count', ['date', 'xcs', 'via', 'iszero'], aggfunc=np.sum))
-        data.reset_index(inplace=True)
-        data['via'] = data.apply(lambda r: ('a' if r['iszero'][:1] == 'y' else 'b') + r['via'][:1], axis=1)
+        data = rollUp(cube, ['date', 'xcs', 'via', 'iszero'])
+        data['via'] = np.where(data['iszero'].str[:1] == 'y', 'a', 'b').astype(object) + data['via'].str[:1]
         data.drop('iszero', axis=1, inplace=True)
         self.createClippedData('RawData:YearDailyViaIsZero', data)
         self.createPeriodData('RawData:WeeklyViaIsZero', data, weekly)
         self.createPeriodData('RawData:MonthlyViaIsZero', data, monthly)
 
         allowedSubdomains = ['m', 'zero']
-        data = allData[(allData.ison == 'y') & (allData.iszero == 'y') & (allData.subdomain.isin(allowedSubdomains))]
-        data = DataFrame(pivot_table(data, 'count', ['date', 'xcs', 'subdomain'], aggfunc=np.sum))
-        data.reset_index(inplace=True)
+        data = rollUp(cube, ['date', 'xcs', 'subdomain'],
+                      (cube.ison == 'y') & (cube.iszero == 'y') & (cube.subdomain.isin(allowedSubdomains)))
 
         self.createClippedData('RawData:YearDailySubdomains', data)
         self.createPeriodData('RawData:WeeklySubdomains', data, weekly)
         self.createPeriodData('RawData:MonthlySubdomains', data, monthly)
 
         # create an artificial yes/no/opera sums
-        opera = allData[(allData.via == 'OPERA') & (allData.iszero == 'y')]
-        opera['str'] = 'o'
-        yes = allData[allData.iszero == 'y']
-        yes['str'] = 'y'
-        no = allData[allData.iszero == 'n']
-        no['str'] = 'n'
-        combined = opera.append(yes).append(no)
-        data = DataFrame(pivot_table(combined, 'count', ['date', 'xcs', 'str'], aggfunc=np.sum))
-        data.reset_index(inplace=True)
+        isZero = cube.iszero == 'y'
+        sums = []
+        for name, mask in (('o', isZero & (cube.via == 'OPERA')), ('y', isZero), ('n', cube.iszero == 'n')):
+            part = rollUp(cube, ['date', 'xcs'], mask)
+            part.insert(2, 'str', name)
+            sums.append(part)
+        data = concat(sums, ignore_index=True).sort_values(['date', 'xcs', 'str'])
+        data.reset_index(drop=True, inplace=True)
 
         headerFields = 'date,xcs,iszero,count'  # Override "str" as "iszero"
         self.createClippedData('RawData:YearDailyTotals', data, headerFields)
         self.createPeriodData('RawData:MonthlyTotals', data, monthly, headerFields)
 
         data = []
-        for xcsId in list(allData.xcs.unique()):
-            byLang = pivot_table(allData[allData.xcs == xcsId], 'count', ['lang'], aggfunc=np.sum) \
-                .order('count', ascending=False)
+        langsByXcs = dict(list(cube.groupby(['xcs', 'lang'])['count'].sum().groupby(level=0)))
+        for xcsId in list(cube.xcs.unique()):
+            byLang = langsByXcs[xcsId].reset_index(level=0, drop=True).order('count', ascending=False)
             top = byLang.head(5)
             vals = list(top.iteritems())
             vals.append(('other', byLang.sum() - top.sum()))
@@ -361,6 +454,44 @@ class WebLogProcessor2(LogProcessor):
 
         self.saveWikiPage('RawData:LangPercent', data, 'lang,xcs,count')
 
+    def isCubeFresh(self):
+        """
+        The saved cube can be reused if it is newer than the combined file, was built by the same cubeVersion,
+        and has the graphColumns
+        """
+        if not os.path.isfile(self.cubeFile):
+            return False
+        if os.path.isfile(self.combinedFile) and \
+                os.path.getmtime(self.combinedFile) > os.path.getmtime(self.cubeFile):
+            return False
+        if loadJson(self.cubeInfoFile, {}).get('version') != cubeVersion:
+            return False
+        with io.open(self.cubeFile, 'rb') as f:
+            header = f.readline().rstrip('\r\n').split('\t')
+        return header == graphColumns + ['count']
+
+    def loadCube(self):
+        """
+        Load the counts of combined-all.tsv summed by graphColumns. The cube is saved next to the combined file,
+        and is only rebuilt when the combined file is newer, or the saved cube does not match this code.
+        """
+        if self.isCubeFresh():
+            cube = read_table(self.cubeFile, sep='\t', na_filter=False, dtype=dict((c, object) for c in graphColumns))
+        else:
+            safePrint('Building %s' % self.cubeFile)
+            # Only the columns used by the graphs are kept, summed while reading the file in chunks
+            cube = readAggregatedTable(self.combinedFile, graphColumns, isGraphData, self.settings.readChunkRows,
+                                       naFilter=False)
+            tmpFile = self.cubeFile + '.tmp'
+            cube.to_csv(tmpFile, sep='\t', index=False)
+            if os.path.exists(self.cubeFile):
+                os.remove(self.cubeFile)
+            os.rename(tmpFile, self.cubeFile)
+            # Written after the cube, so that an interrupted build is not mistaken for a fresh cube
+            saveJson(self.cubeInfoFile, {'version': cubeVersion, 'columns': graphColumns})
+        cube['date'] = to_datetime(cube['date'], infer_datetime_format=True)
+        return cube
+
     def createClippedData(self, wikiTitle, data, headerFields=False):
         """
         Convert daily data to monthly data
@@ -502,9 +633,12 @@ class WebLogProcessor2(LogProcessor):
                 f.write(text)
 
     def run(self):
-        self.runHql()
-        self.combineStats()
-        self.generateGraphData()
+        with self.stage('runHql'):
+            self.runHql()
+        with self.stage('combineStats'):
+            self.combineStats()
+        with self.stage('generateGraphData'):
+            self.generateGraphData()
 
     def manualRun(self):
         self.allowEdit = False